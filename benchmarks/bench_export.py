@@ -0,0 +1,240 @@
+"""导出流水线基准测试。
+
+离线运行，使用固定随机种子生成 10 ~ 50k 张卡片的合成卡组，逐阶段记录耗时
+（多次运行取最小值）与 tracemalloc 峰值内存，结果保存为 JSON，并可与基线比较：
+
+    python -m benchmarks.bench_export --output bench.json
+    python -m benchmarks.bench_export --baseline bench.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+from server.anki_utils import gen_anki
+from server.data_models import ChunkDocument
+from server.document_utils import (
+    _apply_table_styles,
+    _create_table,
+    _fill_table_data,
+    create_document,
+)
+from server.html_parser import HTMLToWordParser, compile_html
+from server.ooxml_writer import generate_tables_ooxml
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 50000]
+# python-docx 对象模型逐单元格构建较慢，超过此规模时跳过
+PYTHON_DOCX_MAX_CHUNKS = 2000
+
+WORDS = ["apple", "run", "bright", "theory", "quickly", "河流", "记忆", "复习", "make up", "take off"]
+TAGS = ["b", "i", "u", "sub", "strong", "em"]
+ICONS = ["→", "①", "②", "③"]
+
+
+def _html(rng: random.Random, max_depth: int) -> str:
+    def fragment(depth: int) -> str:
+        text = " ".join(rng.choices(WORDS, k=rng.randint(1, 4)))
+        if depth == 0 or rng.random() < 0.4:
+            return text
+        tag = rng.choice(TAGS)
+        return f"{text} <{tag}>{fragment(depth - 1)}</{tag}>"
+
+    return "".join(f"<p>{fragment(max_depth)}</p>" for _ in range(rng.randint(1, 2)))
+
+
+def synthetic_deck(
+    size: int, seed: int = 0, max_depth: int = 3, max_additions: int = 3
+) -> dict[str, Any]:
+    rng = random.Random(seed)
+    return {
+        "version": 4,
+        "title": f"Benchmark {size}",
+        "footer": _html(rng, max_depth),
+        "deckType": "one-side",
+        "records": [
+            {
+                "id": f"c{i}",
+                "level": rng.choice("ABCD"),
+                "front": _html(rng, max_depth),
+                "back": _html(rng, max_depth),
+                "additions": [
+                    {
+                        "id": f"c{i}a{j}",
+                        "icon": rng.choice(ICONS),
+                        "front": _html(rng, max_depth),
+                        "back": _html(rng, max_depth),
+                    }
+                    for j in range(rng.randint(0, max_additions))
+                ],
+            }
+            for i in range(size)
+        ],
+    }
+
+
+# 每个阶段接收卡组 JSON，返回待计时的无参函数（准备工作不计入）
+def stage_validate(payload: dict[str, Any]) -> Callable[[], Any]:
+    return lambda: ChunkDocument.model_validate(payload)
+
+
+def stage_html_parse(payload: dict[str, Any]) -> Callable[[], Any]:
+    document = ChunkDocument.model_validate(payload)
+    fragments = [
+        html for c in document.records for html in (c.get_merged_front(), c.get_merged_back())
+    ]
+
+    def run():
+        compile_html.cache_clear()
+        for html in fragments:
+            HTMLToWordParser.compile(html)
+
+    return run
+
+
+def stage_create_document(payload: dict[str, Any]) -> Callable[[], Any]:
+    document = ChunkDocument.model_validate(payload)
+    return lambda: create_document(document)
+
+
+def stage_python_docx_tables(payload: dict[str, Any]) -> Callable[[], Any] | None:
+    if len(payload["records"]) > PYTHON_DOCX_MAX_CHUNKS:
+        return None
+    document = ChunkDocument.model_validate(payload)
+
+    def run():
+        compile_html.cache_clear()
+        doc = create_document(document)
+        table = _create_table(doc, document.records)
+        _apply_table_styles(table)
+        _fill_table_data(table, document.records)
+
+    return run
+
+
+def stage_ooxml_tables(payload: dict[str, Any]) -> Callable[[], Any]:
+    document = ChunkDocument.model_validate(payload)
+
+    def run():
+        compile_html.cache_clear()
+        generate_tables_ooxml(create_document(document), document.records)
+
+    return run
+
+
+def stage_gen_anki(payload: dict[str, Any]) -> Callable[[], Any]:
+    document = ChunkDocument.model_validate(payload)
+    path = Path(tempfile.gettempdir()) / "anki_maker_bench.apkg"
+    return lambda: gen_anki(document.records, document.deckType, path)
+
+
+STAGES: dict[str, Callable[[dict[str, Any]], Callable[[], Any] | None]] = {
+    "validate": stage_validate,
+    "html_parse": stage_html_parse,
+    "create_document": stage_create_document,
+    "python_docx_tables": stage_python_docx_tables,
+    "ooxml_tables": stage_ooxml_tables,
+    "gen_anki": stage_gen_anki,
+}
+
+
+def measure(run: Callable[[], Any], repeat: int) -> tuple[float, int]:
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    # 峰值内存单独测量一次，避免 tracemalloc 的开销影响计时
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(
+    sizes: list[int], stages: list[str], repeat: int, seed: int
+) -> list[dict[str, Any]]:
+    results = []
+    for size in sizes:
+        payload = synthetic_deck(size, seed)
+        for name in stages:
+            run = STAGES[name](payload)
+            if run is None:
+                continue
+            seconds, peak = measure(run, repeat)
+            results.append(
+                {"stage": name, "chunks": size, "seconds": seconds, "peak_bytes": peak}
+            )
+            print(
+                f"{name:<20} {size:>6} chunks  {seconds * 1000:>10.1f} ms  "
+                f"{peak / 1024**2:>8.1f} MiB",
+                flush=True,
+            )
+    return results
+
+
+def compare(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> list[str]:
+    previous = {(r["stage"], r["chunks"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = previous.get((result["stage"], result["chunks"]))
+        if base is None:
+            continue
+        for key in ("seconds", "peak_bytes"):
+            ratio = result[key] / base[key] if base[key] else 1.0
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{result['stage']} @ {result['chunks']} chunks: "
+                    f"{key} {base[key]:.4g} -> {result[key]:.4g} ({ratio:.2f}x)"
+                )
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the export pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write results as JSON")
+    parser.add_argument("--baseline", type=Path, help="compare against a saved result")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.stages, args.repeat, args.seed)
+
+    if args.output:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "results": results,
+                },
+                indent=2,
+            ),
+            encoding="utf-8",
+        )
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""服务冷启动基准。
+
+在全新的解释器中导入 server.main 并记录耗时（多次运行取最小值），检查
+python-docx / genanki / MCP 等重量级依赖没有在启动时加载；--serve 另外启动
+uvicorn，测量从进程启动到 /healthz 首次响应的时间。超出预算时以非零状态退出：
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --serve --budget 0.8
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import time
+
+# 这些依赖只应在工作进程或首次使用 MCP 时导入
+HEAVY_MODULES = ["docx", "genanki", "lxml", "mcp"]
+DEFAULT_BUDGET = 0.8
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import server.main
+seconds = time.perf_counter() - start
+loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(json.dumps({{"seconds": seconds, "loaded": loaded}}))
+"""
+
+
+def measure_import(repeat: int) -> tuple[float, list[str]]:
+    seconds = float("inf")
+    loaded: list[str] = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE], check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        seconds = min(seconds, result["seconds"])
+        loaded = result["loaded"]
+    return seconds, loaded
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _healthy(port: int) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+            sock.sendall(b"GET /healthz HTTP/1.0\r\n\r\n")
+            return sock.recv(12).endswith(b"200")
+    except OSError:
+        return False
+
+
+def measure_serve(repeat: int, timeout: float = 30) -> float:
+    seconds = float("inf")
+    for _ in range(repeat):
+        port = _free_port()
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server.main:app", "--port", str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            while not _healthy(port):
+                if process.poll() is not None or time.perf_counter() - start > timeout:
+                    raise RuntimeError("server did not become healthy")
+                time.sleep(0.01)
+            seconds = min(seconds, time.perf_counter() - start)
+        finally:
+            process.terminate()
+            process.wait()
+    return seconds
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark server cold start.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--budget", type=float, default=DEFAULT_BUDGET, help="import time budget (s)"
+    )
+    parser.add_argument("--serve", action="store_true", help="also time /healthz")
+    args = parser.parse_args(argv)
+
+    failures = []
+    seconds, loaded = measure_import(args.repeat)
+    print(f"{'import server.main':<20} {seconds * 1000:>10.1f} ms", flush=True)
+    if seconds > args.budget:
+        failures.append(f"import took {seconds:.3f}s, budget {args.budget:.3f}s")
+    if loaded:
+        failures.append(f"loaded at import time: {', '.join(loaded)}")
+
+    if args.serve:
+        ready = measure_serve(args.repeat)
+        print(f"{'first /healthz':<20} {ready * 1000:>10.1f} ms", flush=True)
+
+    for line in failures:
+        print(f"REGRESSION {line}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from os import getenv
+
+from server.data_models import ChunkDocument
+
+# 同时在途（排队或生成中）的生成任务上限
+ADMISSION_MAX_INFLIGHT = int(getenv("ADMISSION_MAX_INFLIGHT", "8"))
+# 在途生成任务的估算内存总上限（字节），应小于容器内存限制
+ADMISSION_MAX_BYTES = int(getenv("ADMISSION_MAX_BYTES", str(2 * 1024**3)))
+ADMISSION_MAX_RETRY_AFTER = 60
+
+# 内存估算系数，按 benchmarks 合成卡组实测 RSS 拟合：Word 表格是主体，
+# 每行约 24KiB，另加每字节 HTML 约 64B；另有工作进程处理单个文档的固定开销
+COST_BASE_BYTES = 8 * 1024**2
+COST_ROW_BYTES = 24 * 1024
+COST_TEXT_BYTE = 64
+# 只生成 .apkg 时没有 Word 表格：内存 SQLite 中每行约 1KiB，另加每字节 HTML 约 4B
+COST_APKG_ROW_BYTES = 1024
+COST_APKG_TEXT_BYTE = 4
+# 尚无实测数据时假定的每行生成耗时（秒）
+INITIAL_SECONDS_PER_ROW = 0.01
+# 只知道字节数时，按每行约此字节数推算行数（用于估计完成时间）
+PAYLOAD_BYTES_PER_ROW = 640
+
+
+class AdmissionRejected(Exception):
+    status_code = 503
+    headers: dict[str, str] = {}
+
+
+class Overloaded(AdmissionRejected):
+    status_code = 429
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.headers = {"Retry-After": str(retry_after)}
+
+
+class TooLarge(AdmissionRejected):
+    status_code = 413
+
+    def __init__(self):
+        super().__init__(
+            "Document too large to generate; split it with rows_per_volume or into batches"
+        )
+
+
+@dataclass(frozen=True)
+class Cost:
+    rows: int
+    memory: int
+
+
+def estimate_cost(rows: int, text_bytes: int, rows_per_volume: int | None = None) -> Cost:
+    # 分卷时工作进程一次只构建一卷，内存按单卷估算
+    memory_rows, memory_text = rows, text_bytes
+    if rows_per_volume and rows > rows_per_volume:
+        memory_text = text_bytes * rows_per_volume // rows
+        memory_rows = rows_per_volume
+    memory = COST_BASE_BYTES + memory_rows * COST_ROW_BYTES + memory_text * COST_TEXT_BYTE
+    return Cost(rows, memory)
+
+
+def estimate_apkg_cost(rows: int, text_bytes: int) -> Cost:
+    memory = COST_BASE_BYTES + rows * COST_APKG_ROW_BYTES + text_bytes * COST_APKG_TEXT_BYTE
+    return Cost(rows, memory)
+
+
+def _text_bytes(document: ChunkDocument) -> int:
+    return sum(
+        len(chunk.front)
+        + len(chunk.back)
+        + sum(len(a.front) + len(a.back) for a in chunk.additions)
+        for chunk in document.records
+    )
+
+
+def document_cost(document: ChunkDocument, rows_per_volume: int | None = None) -> Cost:
+    return estimate_cost(len(document.records), _text_bytes(document), rows_per_volume)
+
+
+def apkg_cost(documents: list[ChunkDocument]) -> Cost:
+    # 只生成 .apkg（合并卡组、增量导出）：全部文档在同一工作进程内写入一个集合
+    rows = sum(len(document.records) for document in documents)
+    text_bytes = sum(_text_bytes(document) for document in documents)
+    return estimate_apkg_cost(rows, text_bytes)
+
+
+def batch_cost(documents: list[ChunkDocument], concurrency: int) -> Cost:
+    # 整批作为一个任务占用名额：各文档在进程池中排队，同一时刻至多 concurrency 个在内存中
+    costs = [document_cost(document) for document in documents]
+    largest = sorted((cost.memory for cost in costs), reverse=True)[:concurrency]
+    return Cost(sum(cost.rows for cost in costs), sum(largest))
+
+
+def payload_cost(size: int, file_type: str = "docx") -> Cost:
+    # 只知道请求体/文档记录的字节数时（流式上传、延迟生成），内存整体按 HTML 字节估算；
+    # 只生成 .apkg 时按 apkg 系数，行数由字节数推算
+    rows = size // PAYLOAD_BYTES_PER_ROW
+    if file_type == "apkg":
+        return estimate_apkg_cost(rows, size)
+    return Cost(rows, estimate_cost(0, size).memory)
+
+
+@dataclass(eq=False)
+class Ticket:
+    cost: Cost
+    admitted_at: float = field(default_factory=time.monotonic)
+
+
+class AdmissionController:
+    """按并发数与估算内存限制在途生成任务，超限时拒绝而不是排队。"""
+
+    def __init__(self, max_inflight: int, max_bytes: int):
+        self.max_inflight = max_inflight
+        self.max_bytes = max_bytes
+        self._tickets: list[Ticket] = []
+        self._memory = 0
+        self._seconds_per_row = INITIAL_SECONDS_PER_ROW
+        self._lock = threading.Lock()
+
+    def _fits(self, cost: Cost, tickets: list[Ticket], memory: int) -> bool:
+        return len(tickets) < self.max_inflight and memory + cost.memory <= self.max_bytes
+
+    def _retry_after(self, cost: Cost) -> int:
+        # 按各在途任务的预计完成时间依次释放，找到足以容纳新任务的最早时刻
+        now = time.monotonic()
+        remaining = sorted(self._tickets, key=self._expected_finish)
+        memory = self._memory
+        wait = 0.0
+        while remaining and not self._fits(cost, remaining, memory):
+            ticket = remaining.pop(0)
+            memory -= ticket.cost.memory
+            wait = self._expected_finish(ticket) - now
+        return min(ADMISSION_MAX_RETRY_AFTER, max(1, math.ceil(wait)))
+
+    def _expected_finish(self, ticket: Ticket) -> float:
+        return ticket.admitted_at + ticket.cost.rows * self._seconds_per_row
+
+    def check(self, cost: Cost):
+        # 只检查不占用：用于延迟生成，提前告知调用方当前无法完成
+        if cost.memory > self.max_bytes:
+            raise TooLarge()
+        with self._lock:
+            if not self._fits(cost, self._tickets, self._memory):
+                raise Overloaded(self._retry_after(cost))
+
+    def admit(self, cost: Cost) -> Ticket:
+        if cost.memory > self.max_bytes:
+            raise TooLarge()
+        with self._lock:
+            if not self._fits(cost, self._tickets, self._memory):
+                raise Overloaded(self._retry_after(cost))
+            ticket = Ticket(cost)
+            self._tickets.append(ticket)
+            self._memory += cost.memory
+            return ticket
+
+    def release(self, ticket: Ticket):
+        elapsed = time.monotonic() - ticket.admitted_at
+        with self._lock:
+            self._tickets.remove(ticket)
+            self._memory -= ticket.cost.memory
+            if ticket.cost.rows:
+                # 指数平均，跟随当前负载下的实际速度
+                observed = elapsed / ticket.cost.rows
+                self._seconds_per_row = 0.8 * self._seconds_per_row + 0.2 * observed
+
+    def stats(self) -> tuple[int, int]:
+        with self._lock:
+            return len(self._tickets), self._memory
+
+
+admission = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_MAX_BYTES)
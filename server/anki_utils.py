@@ -1,9 +1,14 @@
+import hashlib
 from pathlib import Path
-from typing import Literal
+from typing import Iterable, Iterator, Literal
 
-from genanki import Model, Note, Deck, Package
+from genanki import Model
 
-from server.data_models import Chunk
+from genanki.util import guid_for
+
+from server.apkg_writer import ApkgWriter, NoteRecord
+from server.data_models import Chunk, ChunkDocument
+from server.media_store import anki_field, existing_media
 
 CSS = """
 .card {
@@ -89,22 +94,94 @@ MODEL_DICT = {
 DECK_ID = 2973800905
 
 
+def deck_id_for(name: str) -> int:
+    # 由卡组名稳定地派生卡组 ID，多卡组导出时各子卡组互不冲突
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    return (1 << 30) + int.from_bytes(digest[:4], "big") % (1 << 30)
+
+
+def chunk_notes(
+    chunks: Iterable[Chunk], media: set[str] | None = None
+) -> Iterator[NoteRecord]:
+    # GUID 由卡片 ID 派生：编辑内容后重新导出，Anki 会更新原笔记而不是新建；
+    # 图片链接换成 Anki 媒体文件名，传入 media 时收集引用到的文件名
+    media = set() if media is None else media
+    for chunk in chunks:
+        fields = (
+            anki_field(chunk.get_merged_front(), media),
+            anki_field(chunk.get_merged_back(), media),
+        )
+        yield NoteRecord(fields=fields, guid=guid_for(chunk.id))
+
+
+def chunk_fingerprint(chunk: Chunk, deck_type: str) -> str:
+    content = "\x1f".join((deck_type, chunk.get_merged_front(), chunk.get_merged_back()))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+def deck_manifest(document: ChunkDocument) -> dict[str, str]:
+    return {
+        chunk.id: chunk_fingerprint(chunk, document.deckType)
+        for chunk in document.records
+    }
+
+
 def gen_anki(
-    chunks: list[Chunk],
+    chunks: Iterable[Chunk],
     deck_type: Literal["one-side", "two-sides", "type"],
     file_path: Path,
 ):
-    notes = [
-        Note(
-            model=MODEL_DICT[deck_type],
-            fields=[chunk.get_merged_front(), chunk.get_merged_back()],
+    writer = ApkgWriter()
+    media: set[str] = set()
+    writer.add_deck(
+        DECK_ID, "Generated", MODEL_DICT[deck_type], chunk_notes(chunks, media)
+    )
+    writer.add_media(existing_media(media))
+    writer.write(file_path)
+
+
+def gen_anki_multi(documents: list[ChunkDocument], parent_name: str, file_path: Path):
+    # 每个文档成为 parent_name 下的一个子卡组
+    writer = ApkgWriter()
+    media: set[str] = set()
+    used_names: set[str] = set()
+    for document in documents:
+        name = f"{parent_name}::{document.title}"
+        suffix = 2
+        while name in used_names:
+            name = f"{parent_name}::{document.title} ({suffix})"
+            suffix += 1
+        used_names.add(name)
+        writer.add_deck(
+            deck_id_for(name),
+            name,
+            MODEL_DICT[document.deckType],
+            chunk_notes(document.records, media),
         )
-        for chunk in chunks
-    ]
+    writer.add_media(existing_media(media))
+    writer.write(file_path)
+
 
-    deck = Deck(DECK_ID, "Generated")
-    for note in notes:
-        deck.add_note(note)
+def gen_anki_delta(
+    document: ChunkDocument, previous_manifest: dict[str, str], file_path: Path
+) -> dict[str, list[str]]:
+    # 只导出相对上次清单新增或修改的卡片
+    changed = [
+        chunk
+        for chunk in document.records
+        if previous_manifest.get(chunk.id) != chunk_fingerprint(chunk, document.deckType)
+    ]
+    writer = ApkgWriter()
+    media: set[str] = set()
+    writer.add_deck(
+        DECK_ID, "Generated", MODEL_DICT[document.deckType], chunk_notes(changed, media)
+    )
+    writer.add_media(existing_media(media))
+    writer.write(file_path)
 
-    pkg = Package(deck)
-    pkg.write_to_file(file_path)
+    current_ids = {chunk.id for chunk in document.records}
+    return {
+        "added": [chunk.id for chunk in changed if chunk.id not in previous_manifest],
+        "modified": [chunk.id for chunk in changed if chunk.id in previous_manifest],
+        "removed": [chunk_id for chunk_id in previous_manifest if chunk_id not in current_ids],
+    }
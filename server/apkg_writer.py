@@ -0,0 +1,136 @@
+import hashlib
+import html
+import itertools
+import json
+import re
+import sqlite3
+import time
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterable
+
+from genanki import Deck, Model
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+
+INSERT_BATCH_SIZE = 1000
+
+_HTML_TAG = re.compile(r"<[^>]+>")
+
+
+@dataclass(frozen=True, slots=True)
+class NoteRecord:
+    fields: tuple[str, ...]
+    guid: str
+
+
+def field_checksum(value: str) -> int:
+    # 与 Anki 相同：去除 HTML 后取 SHA1 前 8 位
+    text = html.unescape(_HTML_TAG.sub("", value))
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+class ApkgWriter:
+    """在内存 SQLite 中批量构建 Anki 集合，再直接写出 .apkg，不产生临时文件。
+
+    表结构与行格式与 genanki.Package.write_to_file 一致。
+    """
+
+    def __init__(self, timestamp: float | None = None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self._ids = itertools.count(int(self.timestamp * 1000))
+        self._conn = sqlite3.connect(":memory:")
+        self._conn.executescript(APKG_SCHEMA)
+        self._conn.executescript(APKG_COL)
+        self._decks: dict[str, dict] = {}
+        self._models: dict[str, dict] = {}
+        self._media: dict[str, Path] = {}
+
+    def add_media(self, paths: Iterable[Path]):
+        # 字段中以文件名引用的图片等媒体，按文件名去重
+        for path in paths:
+            self._media[path.name] = path
+
+    def add_deck(
+        self, deck_id: int, name: str, model: Model, notes: Iterable[NoteRecord]
+    ) -> int:
+        self._decks[str(deck_id)] = Deck(deck_id, name).to_json()
+        self._models[str(model.model_id)] = model.to_json(self.timestamp, deck_id)
+
+        mod = int(self.timestamp)
+        count = 0
+        iterator = iter(notes)
+        while batch := list(itertools.islice(iterator, INSERT_BATCH_SIZE)):
+            note_rows = []
+            card_rows = []
+            for note in batch:
+                note_id = next(self._ids)
+                note_rows.append(
+                    (
+                        note_id,
+                        note.guid,
+                        model.model_id,
+                        mod,
+                        -1,
+                        "  ",
+                        "\x1f".join(note.fields),
+                        note.fields[model.sort_field_index],
+                        field_checksum(note.fields[model.sort_field_index]),
+                        0,
+                        "",
+                    )
+                )
+                for card_ord in _card_ords(model, note.fields):
+                    card_rows.append(
+                        (next(self._ids), note_id, deck_id, card_ord, mod, -1)
+                        + (0,) * 11
+                        + ("",)
+                    )
+            self._conn.executemany(
+                "INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?)", note_rows
+            )
+            self._conn.executemany(
+                "INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                card_rows,
+            )
+            count += len(batch)
+        return count
+
+    def collection_bytes(self) -> bytes:
+        decks_json, models_json = self._conn.execute(
+            "SELECT decks, models FROM col"
+        ).fetchone()
+        decks = json.loads(decks_json)
+        decks.update(self._decks)
+        models = json.loads(models_json)
+        models.update(self._models)
+        self._conn.execute(
+            "UPDATE col SET decks = ?, models = ?",
+            (json.dumps(decks), json.dumps(models)),
+        )
+        self._conn.commit()
+        return self._conn.serialize()
+
+    def write(self, target: str | Path | BinaryIO):
+        # target 可以是路径，也可以是任意可写的二进制流（无需支持 seek）
+        collection = self.collection_bytes()
+        self._conn.close()
+        with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as outzip:
+            outzip.writestr("collection.anki2", collection)
+            # 媒体以序号为条目名，"media" 映射序号到文件名；图片本身已压缩，直接存储
+            media = {}
+            for i, (name, path) in enumerate(self._media.items()):
+                outzip.write(path, str(i), compress_type=zipfile.ZIP_STORED)
+                media[str(i)] = name
+            outzip.writestr("media", json.dumps(media))
+
+
+def _card_ords(model: Model, fields: tuple[str, ...]) -> list[int]:
+    # 与 genanki.Note._front_back_cards 相同的规则
+    ords = []
+    for card_ord, any_or_all, required_field_ords in model._req:
+        op = any if any_or_all == "any" else all
+        if op(fields[i] for i in required_field_ords):
+            ords.append(card_ord)
+    return ords
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from os import getenv
+
+from server.config import OUTPUT_DIR
+from server.data_models import ChunkDocument
+from server.generation import ExportOptions, Filenames, artifact_files, spec_path
+
+ARTIFACT_CACHE_SIZE = int(getenv("ARTIFACT_CACHE_SIZE", "256"))
+ARTIFACT_CACHE_TTL = int(getenv("ARTIFACT_CACHE_TTL", str(3600 * 12)))
+
+
+def document_fingerprint(document: ChunkDocument, options: ExportOptions) -> str:
+    # 字段顺序由模型定义固定，model_dump_json 的输出可直接作为规范形式
+    digest = hashlib.sha256(
+        document.model_dump_json(include={"records", "title", "footer", "deckType"})
+        .encode("utf-8")
+    )
+    digest.update(options.model_dump_json().encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _is_available(filename: str) -> bool:
+    # 已生成，或仍保留着可用于延迟生成的文档记录
+    file_id = filename.partition(".")[0]
+    return (OUTPUT_DIR / filename).exists() or spec_path(OUTPUT_DIR, file_id).exists()
+
+
+def _is_built(filename: str) -> bool:
+    return (OUTPUT_DIR / filename).exists()
+
+
+class ArtifactCache:
+    """指纹 -> 文件名，按条目数和存活时间淘汰（LRU）。
+
+    延迟生成的记录标记为未构建：文件名已分配，但文件要到首次下载时才生成。
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[Filenames, float, bool]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, built: bool = False) -> Filenames | None:
+        # built：只接受文件都已在磁盘上的条目（延迟记录在全部格式下载过后也算）
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            filenames, created_at, is_built = entry
+            check = _is_built if is_built else _is_available
+            names = artifact_files(filenames)
+            if time.time() - created_at > self.ttl or not all(map(check, names)):
+                del self._entries[key]
+                return None
+            if built and not is_built and not all(map(_is_built, names)):
+                return None
+            self._entries.move_to_end(key)
+            return filenames
+
+    def put(self, key: str, filenames: Filenames, built: bool = True):
+        with self._lock:
+            self._entries[key] = (filenames, time.time(), built)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_SIZE, ARTIFACT_CACHE_TTL)
@@ -0,0 +1,71 @@
+import zipfile
+from pathlib import Path
+from typing import Literal
+
+from nanoid import generate
+from pydantic import BaseModel, Field
+
+from server.admission import apkg_cost
+from server.config import OUTPUT_DIR
+from server.data_models import ChunkDocument
+from server.file_expiry import output_index
+from server.generation import DocxEngine, ExportOptions, safe_title, write_atomic
+from server.jobs import run_generation_batch, run_in_pool
+
+
+class BatchRequest(BaseModel):
+    documents: list[ChunkDocument] = Field(min_length=1)
+    # apkg：合并为一个含子卡组的 .apkg；zip：每个文档各自的 .docx/.apkg 打包为 .zip
+    mode: Literal["apkg", "zip"] = "apkg"
+    title: str = "Batch"
+    docx_engine: DocxEngine = "python-docx"
+
+
+def build_batch_apkg(
+    documents: list[ChunkDocument], parent_name: str, output_dir: Path, file_id: str
+) -> str:
+    from server.anki_utils import gen_anki_multi
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    filename = f"{file_id}.apkg"
+    write_atomic(
+        output_dir, filename, lambda path: gen_anki_multi(documents, parent_name, path)
+    )
+    return filename
+
+
+def bundle_files(output_dir: Path, file_id: str, entries: list[tuple[str, str]]) -> str:
+    # .docx/.apkg 本身已是压缩包，直接存储即可
+    def write(path: Path):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as outzip:
+            for arcname, filename in entries:
+                outzip.write(output_dir / filename, arcname)
+
+    write_atomic(output_dir, f"{file_id}.zip", write)
+    return f"{file_id}.zip"
+
+
+async def run_batch(request: BatchRequest) -> str:
+    file_id = safe_title(request.title) + "_" + generate()
+    if request.mode == "apkg":
+        filename = await run_in_pool(
+            build_batch_apkg,
+            request.documents,
+            request.title,
+            OUTPUT_DIR,
+            file_id,
+            cost=apkg_cost(request.documents),
+        )
+    else:
+        # 各文档分别提交到生成进程池并行构建，相同内容可命中产物缓存；
+        # 整批只占用一个名额，文档数超过在途上限时在进程池中排队而不是被拒绝
+        options = ExportOptions(docx_engine=request.docx_engine)
+        results = await run_generation_batch(request.documents, options)
+        entries = []
+        for i, (document, file_info) in enumerate(zip(request.documents, results), 1):
+            name = f"{i:03d}_{safe_title(document.title)}"
+            entries.append((f"{name}.docx", file_info["docx_filename"]))
+            entries.append((f"{name}.apkg", file_info["apkg_filename"]))
+        filename = await run_in_pool(bundle_files, OUTPUT_DIR, file_id, entries)
+    output_index.track(filename)
+    return filename
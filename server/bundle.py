@@ -0,0 +1,60 @@
+import io
+import zipfile
+from pathlib import Path
+from typing import Iterator
+
+from server.generation import FILE_TYPES, FileType
+
+BUNDLE_BLOCK_SIZE = 64 << 10
+
+
+class _ZipSink(io.RawIOBase):
+    """只写、不可定位的内存缓冲；zipfile 写入后由生成器取走已写出的字节。"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def bundle_paths(output_dir: Path, file_id: str) -> dict[FileType, list[Path]]:
+    # 单卷为 {id}.docx，分卷为 {id}.vol1.docx、{id}.vol2.docx ...
+    paths: dict[FileType, list[Path]] = {file_type: [] for file_type in FILE_TYPES}
+    for file_type in FILE_TYPES:
+        path = output_dir / f"{file_id}.{file_type}"
+        if path.exists():
+            paths[file_type].append(path)
+    if not paths["docx"]:
+        volume = 1
+        while (path := output_dir / f"{file_id}.vol{volume}.docx").exists():
+            paths["docx"].append(path)
+            volume += 1
+    return paths
+
+
+def iter_zip(paths: list[Path]) -> Iterator[bytes]:
+    # 边读边写出 ZIP（仅存储不压缩，.docx/.apkg 本身已是压缩包），
+    # 不在磁盘上生成压缩文件；ZipInfo 带上文件大小，超过 4GB 时自动使用 zip64
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as bundle:
+        for path in paths:
+            info = zipfile.ZipInfo.from_file(path, path.name)
+            with open(path, "rb") as source, bundle.open(info, "w") as target:
+                while block := source.read(BUNDLE_BLOCK_SIZE):
+                    target.write(block)
+                    if data := sink.drain():
+                        yield data
+            if data := sink.drain():
+                yield data
+    if data := sink.drain():
+        yield data
@@ -0,0 +1,8 @@
+from os import getenv
+from pathlib import Path
+
+PRODUCTION = getenv("APP_ENV") == "production"
+OUTPUT_DIR = Path("/app/output") if PRODUCTION else Path("./temp")
+# 草稿数据库等内部数据，不能放在 /api/download 对外提供的输出目录中
+DATA_DIR = Path("/app/data") if PRODUCTION else Path("./data")
+MEDIA_DIR = OUTPUT_DIR / "media"
@@ -1,3 +1,4 @@
+from functools import cached_property
 from typing import Literal
 from pydantic import BaseModel, Field
 
@@ -20,20 +21,29 @@ class Chunk(BaseModel):
     back: str
     additions: list[Addition] = Field(default_factory=Addition.empty_additions)
 
-    def get_merged_front(self) -> str:
+    # 合并结果在首次访问时缓存，Word 与 Anki 导出共用同一份
+    @cached_property
+    def merged_front(self) -> str:
         SPACES = "&nbsp;" * 2
         return self.front + "".join(
             f"<p>{SPACES}{a.icon} {self.dissolve_p_tags(a.front)}</p>"
             for a in self.additions
         )
 
-    def get_merged_back(self) -> str:
+    @cached_property
+    def merged_back(self) -> str:
         SPACES = "&nbsp;" * 2
         return self.back + "".join(
             f"<p>{SPACES}{a.icon} {self.dissolve_p_tags(a.back)}</p>"
             for a in self.additions
         )
 
+    def get_merged_front(self) -> str:
+        return self.merged_front
+
+    def get_merged_back(self) -> str:
+        return self.merged_back
+
     @staticmethod
     def dissolve_p_tags(text: str) -> str:
         return text.replace("<p>", "").replace("</p>", "")
@@ -45,3 +55,10 @@ class ChunkDocument(BaseModel):
     title: str
     footer: str = Field(default="")
     deckType: Literal["one-side", "two-sides", "type"] = Field(default="one-side")
+
+
+def group_by_level(chunks: list[Chunk]) -> dict[str, list[Chunk]]:
+    grouped: dict[str, list[Chunk]] = {}
+    for chunk in chunks:
+        grouped.setdefault(chunk.level, []).append(chunk)
+    return grouped
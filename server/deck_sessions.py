@@ -0,0 +1,110 @@
+from typing import Any
+
+from server.draft_store import get_draft, modify_draft, save_draft, update_draft
+
+# 分批构建卡组的会话，存放在草稿存储中：
+#   {deck_id}          普通草稿（在线编辑页使用），finalize 时写入完整卡片
+#   {deck_id}.session  会话元数据：已写入的批次数与卡片数
+#   {deck_id}.{n}      第 n 批卡片
+# 卡片 ID 以批次号为前缀（"{n}.{id}"），替换卡片时只需读写所在批次。
+# 客户端常并行调用工具：分配批次号与改写批次都通过 modify_draft 原子完成。
+
+
+def is_internal_key(draft_id: str) -> bool:
+    # 会话元数据与批次带 "." 后缀，普通草稿 ID 不含 "."；草稿接口不对外提供这些键
+    return "." in draft_id
+
+
+def _session_key(deck_id: str) -> str:
+    return f"{deck_id}.session"
+
+
+def _batch_key(deck_id: str, batch: int | str) -> str:
+    return f"{deck_id}.{batch}"
+
+
+def _load_session(deck_id: str) -> dict[str, Any]:
+    session = get_draft(_session_key(deck_id))
+    if session is None:
+        raise ValueError(f"Deck session {deck_id} not found or expired")
+    return session
+
+
+def open_session(title: str, footer: str, deck_type: str) -> str:
+    deck_id = save_draft(
+        {
+            "version": 4,
+            "records": [],
+            "title": title or "Untitled",
+            "footer": footer,
+            "deckType": deck_type,
+        }
+    )
+    update_draft(_session_key(deck_id), {"batches": 0, "cards": 0})
+    return deck_id
+
+
+def append_batch(deck_id: str, records: list[dict[str, Any]]) -> tuple[list[str], int]:
+    # 返回本批卡片的 ID 与会话中的卡片总数
+    def allocate(session: dict[str, Any]) -> dict[str, Any]:
+        session["batches"] += 1
+        session["cards"] += len(records)
+        return session
+
+    session = modify_draft(_session_key(deck_id), allocate)
+    if session is None:
+        raise ValueError(f"Deck session {deck_id} not found or expired")
+    batch = session["batches"]
+    for record in records:
+        record["id"] = f"{batch}.{record['id']}"
+    update_draft(_batch_key(deck_id, batch), {"records": records})
+    return [record["id"] for record in records], session["cards"]
+
+
+def replace_records(deck_id: str, records: list[dict[str, Any]]):
+    # 按 ID 原位替换卡片；先检查全部 ID，任一不存在时不做任何修改
+    _load_session(deck_id)
+    updates: dict[str, list[dict[str, Any]]] = {}
+    for record in records:
+        updates.setdefault(record["id"].partition(".")[0], []).append(record)
+
+    # 批次内的卡片只会原位替换、不会删除，先检查的结果在写入时仍然成立
+    unknown = []
+    for batch, batch_updates in updates.items():
+        stored = get_draft(_batch_key(deck_id, batch)) if batch.isdigit() else None
+        ids = {r["id"] for r in stored["records"]} if stored else set()
+        unknown.extend(r["id"] for r in batch_updates if r["id"] not in ids)
+    if unknown:
+        raise ValueError(f"Unknown card ids: {', '.join(unknown)}")
+
+    for batch, batch_updates in updates.items():
+
+        def replace(stored: dict[str, Any]) -> dict[str, Any]:
+            positions = {r["id"]: i for i, r in enumerate(stored["records"])}
+            for record in batch_updates:
+                stored["records"][positions[record["id"]]] = record
+            return stored
+
+        if modify_draft(_batch_key(deck_id, batch), replace) is None:
+            raise ValueError(f"Deck session {deck_id} expired: batch {batch} is missing")
+
+
+def assemble_session(deck_id: str) -> dict[str, Any]:
+    # 按批次顺序拼出完整草稿并写回 {deck_id}；会话保留，可继续追加后再次生成
+    session = _load_session(deck_id)
+    records = []
+    for batch in range(1, session["batches"] + 1):
+        stored = get_draft(_batch_key(deck_id, batch))
+        if stored is None:
+            raise ValueError(f"Deck session {deck_id} expired: batch {batch} is missing")
+        records.extend(stored["records"])
+
+    # 只替换卡片，标题等字段保留在线编辑页的并发修改
+    def fill(draft: dict[str, Any]) -> dict[str, Any]:
+        draft["records"] = records
+        return draft
+
+    draft = modify_draft(deck_id, fill)
+    if draft is None:
+        raise ValueError(f"Deck session {deck_id} not found or expired")
+    return draft
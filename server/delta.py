@@ -0,0 +1,63 @@
+from pathlib import Path
+from typing import Any
+
+from nanoid import generate
+from pydantic import BaseModel, Field
+
+from server.admission import apkg_cost
+from server.config import OUTPUT_DIR
+from server.data_models import ChunkDocument
+from server.file_expiry import output_index
+from server.generation import write_atomic
+from server.jobs import run_in_pool
+
+
+class DeltaRequest(BaseModel):
+    document: ChunkDocument
+    # 上次导出返回的清单（卡片ID -> 内容指纹）；为空时导出全部卡片
+    manifest: dict[str, str] = Field(default_factory=dict)
+
+
+def build_delta_apkg(
+    document: ChunkDocument,
+    previous_manifest: dict[str, str],
+    output_dir: Path,
+    file_id: str,
+) -> dict[str, Any]:
+    from server.anki_utils import deck_manifest, gen_anki_delta
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    filename = f"{file_id}.apkg"
+    changes: dict[str, list[str]] = {}
+
+    def write(path: Path):
+        changes.update(gen_anki_delta(document, previous_manifest, path))
+
+    write_atomic(output_dir, filename, write)
+
+    # 没有变化时不返回文件；file_id 是新生成的，删除前不会被其他请求引用
+    apkg_filename = None
+    if changes["added"] or changes["modified"]:
+        apkg_filename = filename
+    else:
+        (output_dir / filename).unlink(missing_ok=True)
+
+    return {
+        "apkg_filename": apkg_filename,
+        "manifest": deck_manifest(document),
+        **changes,
+    }
+
+
+async def run_delta(request: DeltaRequest) -> dict[str, Any]:
+    result = await run_in_pool(
+        build_delta_apkg,
+        request.document,
+        request.manifest,
+        OUTPUT_DIR,
+        generate(),
+        cost=apkg_cost([request.document]),
+    )
+    if result["apkg_filename"] is not None:
+        output_index.track(result["apkg_filename"])
+    return result
@@ -1,4 +1,6 @@
 from datetime import datetime
+from functools import cache
+from io import BytesIO
 
 from docx import Document
 from docx.document import Document as DocumentClass
@@ -7,15 +9,20 @@ from docx.shared import Cm, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_TAB_ALIGNMENT
 from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.table import WD_ALIGN_VERTICAL
-from docx.oxml.ns import qn
+from docx.oxml.ns import nsmap, qn
 from docx.oxml import OxmlElement
 from docx.oxml.xmlchemy import BaseOxmlElement
+from lxml import etree
 
-from server.data_models import Chunk, ChunkDocument
+from server.data_models import Chunk, ChunkDocument, group_by_level
 from server.html_parser import HTMLToWordParser
+from server.ooxml_writer import MEDIA_EMBED_PREFIX
 
 
-def create_document(chunk_document: ChunkDocument) -> DocumentClass:
+@cache
+def document_skeleton() -> bytes:
+    # 页面、页脚与样式在各次导出间完全相同，只构建一次并缓存为 .docx 字节；
+    # 标题和日期留空，由 create_document 填入
     doc = Document()
 
     # 文档基础设置
@@ -37,7 +44,7 @@ def create_document(chunk_document: ChunkDocument) -> DocumentClass:
     tab_stops.add_tab_stop(Cm(16.6), WD_TAB_ALIGNMENT.RIGHT)  # 右侧栏
 
     # 构建页脚内容
-    left_run = paragraph.add_run(datetime.now().strftime("%Y.%m.%d"))
+    left_run = paragraph.add_run()
     left_run.font.name = "Georgia"
     left_run._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
     paragraph.add_run("\t")  # 第一个制表符
@@ -82,38 +89,67 @@ def create_document(chunk_document: ChunkDocument) -> DocumentClass:
     heading_style.paragraph_format.space_before = Pt(10)
     heading_style.paragraph_format.space_after = Pt(4)
 
-    doc.add_heading(level=1).add_run(chunk_document.title).font.name = "Bookman Old Style"
+    doc.add_heading(level=1).add_run().font.name = "Bookman Old Style"
+
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
 
+def create_document(chunk_document: ChunkDocument) -> DocumentClass:
+    doc = Document(BytesIO(document_skeleton()))
+    doc.paragraphs[0].runs[0].text = chunk_document.title
+    doc.sections[0].footer.paragraphs[-1].runs[0].text = datetime.now().strftime("%Y.%m.%d")
     return doc
 
 
 def generate_tables(doc: DocumentClass, records: list[Chunk]):
-    levels = _group_by_level(records)
+    generate_level_tables(doc, group_by_level(records))
+
 
+def generate_level_tables(
+    doc: DocumentClass,
+    levels: dict[str, list[Chunk]],
+    first_numbers: dict[str, int] | None = None,
+):
+    # first_numbers：分卷时某级别从中间续接，序号不从 1 开始
+    first_numbers = first_numbers or {}
     for level, chunks in sorted(levels.items(), key=lambda item: item[0]):
         doc.add_heading(level=2).add_run(level).font.name = "Bookman Old Style"
         table = _create_table(doc, chunks)
         _apply_table_styles(table)
-        _fill_table_data(table, chunks)
+        _fill_table_data(table, chunks, first_numbers.get(level, 1))
         doc.add_paragraph()
 
-def generate_footer(doc: DocumentClass, footerHTML: str):
-    HTMLToWordParser.parse(footerHTML, doc)
 
-def _group_by_level(chunks: list[Chunk]) -> dict[str, list[Chunk]]:
-    grouped: dict[str, list[Chunk]] = {}
-    for chunk in chunks:
-        grouped.setdefault(chunk.level, []).append(chunk)
-    return grouped
+def level_fragment(level: str, chunks: list[Chunk], first_number: int = 1) -> str:
+    # 在骨架文档的副本中生成单个级别的标题与表格，序列化为 <w:body> 片段；
+    # 正文首段是文档标题，末尾是 sectPr，二者之间即为新增的块
+    doc = Document(BytesIO(document_skeleton()))
+    generate_level_tables(doc, {level: chunks}, {level: first_number})
+    # 图片关系只在这份副本中有效，改为按文件名占位，由 append_fragment 重新关联
+    for blip in doc.element.body.iter(qn("a:blip")):
+        image_part = doc.part.related_parts[blip.get(qn("r:embed"))]
+        blip.set(qn("r:embed"), f"{MEDIA_EMBED_PREFIX}{image_part.filename}")
+    blocks = "".join(
+        etree.tostring(block, encoding="unicode") for block in doc.element.body[1:-1]
+    )
+    return f'<w:body xmlns:w="{nsmap["w"]}">{blocks}</w:body>'
+
 
+def generate_footer(doc: DocumentClass, footerHTML: str):
+    HTMLToWordParser.parse(footerHTML, doc)
 
 def _create_table(doc: DocumentClass, chunks: list[Chunk]) -> "Table":
     table = doc.add_table(rows=len(chunks), cols=3)
     table.autofit = False
+    # table.cell() 每次调用都会遍历整张表，这里一次性取出全部单元格（按行排列）
+    cells = table._cells
     for row in range(len(chunks)):
         for i, width in enumerate([1.0, 8.0, 8.0]):
-            table.cell(row, i).width = Cm(width)
-            table.cell(row, i).vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+            cell = cells[row * 3 + i]
+            cell.width = Cm(width)
+            cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
     return table
 
 def _apply_table_styles(table: Table):
@@ -135,15 +171,16 @@ def _add_border(tbl_borders: BaseOxmlElement, position: str, style: str, size: i
     tbl_borders.append(border)
 
 
-def _fill_table_data(table: Table, chunks: list[Chunk]):
+def _fill_table_data(table: Table, chunks: list[Chunk], first_number: int = 1):
+    cells = table._cells
     for i, chunk in enumerate(chunks):
         # 序号列
-        table.cell(i, 0).paragraphs[0].add_run(f"{i+1:02d}", style="number")
+        cells[i * 3].paragraphs[0].add_run(f"{i+first_number:02d}", style="number")
 
         # 前置内容
-        front_cell = table.cell(i, 1)
+        front_cell = cells[i * 3 + 1]
         HTMLToWordParser.parse(chunk.get_merged_front(), front_cell)
 
         # 后置内容
-        back_cell = table.cell(i, 2)
+        back_cell = cells[i * 3 + 2]
         HTMLToWordParser.parse(chunk.get_merged_back(), back_cell)
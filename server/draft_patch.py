@@ -0,0 +1,79 @@
+from typing import Annotated, Any, Literal
+
+from pydantic import BaseModel, Field
+
+from server.data_models import Chunk
+from server.media_store import extract_chunk_media, extract_media
+
+
+class UpsertChunks(BaseModel):
+    op: Literal["upsert"]
+    chunks: list[Chunk]
+
+
+class DeleteChunks(BaseModel):
+    op: Literal["delete"]
+    ids: list[str]
+
+
+class ReorderChunks(BaseModel):
+    op: Literal["reorder"]
+    ids: list[str] = Field(description="草稿中全部卡片 ID 的新顺序")
+
+
+DraftOperation = Annotated[
+    UpsertChunks | DeleteChunks | ReorderChunks, Field(discriminator="op")
+]
+
+
+class DraftPatch(BaseModel):
+    title: str | None = None
+    footer: str | None = None
+    deckType: Literal["one-side", "two-sides", "type"] | None = None
+    operations: list[DraftOperation] = Field(default_factory=list)
+
+
+def extract_patch_media(patch: DraftPatch) -> DraftPatch:
+    # 新写入的卡片与页脚中的内嵌图片提取到媒体目录（写磁盘，在线程中调用）
+    if patch.footer is not None:
+        patch.footer = extract_media(patch.footer)
+    for operation in patch.operations:
+        if isinstance(operation, UpsertChunks):
+            for chunk in operation.chunks:
+                extract_chunk_media(chunk)
+    return patch
+
+
+def apply_draft_patch(data: dict[str, Any], patch: DraftPatch) -> dict[str, Any]:
+    for field in ("title", "footer", "deckType"):
+        value = getattr(patch, field)
+        if value is not None:
+            data[field] = value
+
+    records: list[dict[str, Any]] = data["records"]
+    # ID -> 位置的索引在连续的 upsert 之间复用，删除或重排后才重建
+    positions: dict[str, int] | None = None
+    for operation in patch.operations:
+        if isinstance(operation, UpsertChunks):
+            if positions is None:
+                positions = {record["id"]: i for i, record in enumerate(records)}
+            for chunk in operation.chunks:
+                # 已存在的卡片原位替换，新卡片追加到末尾
+                if chunk.id in positions:
+                    records[positions[chunk.id]] = chunk.model_dump()
+                else:
+                    positions[chunk.id] = len(records)
+                    records.append(chunk.model_dump())
+        elif isinstance(operation, DeleteChunks):
+            removed = set(operation.ids)
+            records = [record for record in records if record["id"] not in removed]
+            positions = None
+        else:
+            by_id = {record["id"]: record for record in records}
+            if len(operation.ids) != len(by_id) or set(operation.ids) != by_id.keys():
+                raise ValueError("Reorder ids do not match the draft's chunks")
+            records = [by_id[chunk_id] for chunk_id in operation.ids]
+            positions = None
+
+    data["records"] = records
+    return data
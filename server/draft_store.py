@@ -1,33 +1,267 @@
+import asyncio
+import heapq
+import queue
+import sqlite3
+import threading
 import time
 import uuid
-from typing import Any
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import getenv
+from pathlib import Path
+from typing import Any, Callable, Iterator, Protocol
+
+import orjson
+
+from server.config import DATA_DIR
 
-_drafts: dict[str, dict[str, Any]] = {}
 DRAFT_TTL = 3600 * 4
+DRAFT_STORE = getenv("DRAFT_STORE", "memory")
+DRAFT_DB_PATH = Path(getenv("DRAFT_DB_PATH", str(DATA_DIR / "drafts.sqlite3")))
+DRAFT_DB_POOL_SIZE = int(getenv("DRAFT_DB_POOL_SIZE", "4"))
+DRAFT_MEMORY_BUDGET = int(getenv("DRAFT_MEMORY_BUDGET", str(64 * 1024**2)))
+DRAFT_CLEANUP_INTERVAL = 600
+
+
+# 草稿以校验后序列化好的 JSON 字节存取，读取接口可原样返回，不再解析后重新编码
+class DraftStore(Protocol):
+    def save(self, draft_id: str, payload: bytes): ...
+
+    def get(self, draft_id: str) -> bytes | None: ...
+
+    # 原子地读取、修改并写回；草稿不存在时返回 False
+    def modify(self, draft_id: str, update: Callable[[bytes], bytes]) -> bool: ...
+
+    def cleanup_expired(self) -> int: ...
+
+    def stats(self) -> dict[str, int]: ...
+
+
+class MemoryDraftStore:
+    """进程内草稿缓存：压缩存储，按字节预算做 LRU 淘汰，过期由到期时间堆驱动。"""
+
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._drafts: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self._deadlines: list[tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def save(self, draft_id: str, payload: bytes):
+        blob = zlib.compress(payload)
+        with self._lock:
+            self._put(draft_id, blob)
+
+    def modify(self, draft_id: str, update: Callable[[bytes], bytes]) -> bool:
+        with self._lock:
+            self._expire(time.time())
+            entry = self._drafts.get(draft_id)
+            if entry is None:
+                return False
+            self._put(draft_id, zlib.compress(update(zlib.decompress(entry[0]))))
+        return True
+
+    def _put(self, draft_id: str, blob: bytes):
+        expires_at = time.time() + self.ttl
+        self._discard(draft_id)
+        self._drafts[draft_id] = (blob, expires_at)
+        self.total_bytes += len(blob)
+        heapq.heappush(self._deadlines, (expires_at, draft_id))
+        # 超出预算时淘汰最久未访问的草稿，但保留刚写入的这一份
+        while self.total_bytes > self.max_bytes and len(self._drafts) > 1:
+            self._discard(next(iter(self._drafts)))
+
+    def get(self, draft_id: str) -> bytes | None:
+        with self._lock:
+            self._expire(time.time())
+            entry = self._drafts.get(draft_id)
+            if entry is None:
+                return None
+            self._drafts.move_to_end(draft_id)
+        return zlib.decompress(entry[0])
+
+    def cleanup_expired(self) -> int:
+        with self._lock:
+            return self._expire(time.time())
+
+    def stats(self) -> dict[str, int]:
+        return {"entries": len(self._drafts), "bytes": self.total_bytes}
+
+    def _discard(self, draft_id: str):
+        entry = self._drafts.pop(draft_id, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[0])
+
+    def _expire(self, now: float) -> int:
+        expired = 0
+        while self._deadlines and self._deadlines[0][0] <= now:
+            expires_at, draft_id = heapq.heappop(self._deadlines)
+            entry = self._drafts.get(draft_id)
+            # 被覆盖或已被 LRU 淘汰的条目在堆中是过时记录，直接跳过
+            if entry is not None and entry[1] == expires_at:
+                self._discard(draft_id)
+                expired += 1
+        return expired
+
+
+class SqliteDraftStore:
+    """WAL 模式的 SQLite 草稿存储，可在多个 uvicorn worker 之间共享。"""
+
+    def __init__(self, path: Path, ttl: float, pool_size: int):
+        self.path = path
+        self.ttl = ttl
+        self._pool: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(pool_size)
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not self._initialized:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS drafts ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS drafts_expires_at ON drafts (expires_at)"
+            )
+            self._initialized = True
+        return conn
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def save(self, draft_id: str, payload: bytes):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO drafts (id, data, expires_at) VALUES (?, ?, ?)",
+                (draft_id, payload, time.time() + self.ttl),
+            )
 
+    def get(self, draft_id: str) -> bytes | None:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT data FROM drafts WHERE id = ? AND expires_at > ?",
+                (draft_id, time.time()),
+            ).fetchone()
+        return None if row is None else _payload(row[0])
 
-def save_draft(data: dict[str, Any]) -> str:
+    def modify(self, draft_id: str, update: Callable[[bytes], bytes]) -> bool:
+        # BEGIN IMMEDIATE 先取得写锁，其他 worker 的并发修改排队而不是互相覆盖
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT data FROM drafts WHERE id = ? AND expires_at > ?",
+                    (draft_id, now),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE drafts SET data = ?, expires_at = ? WHERE id = ?",
+                        (update(_payload(row[0])), now + self.ttl, draft_id),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return row is not None
+
+    def cleanup_expired(self) -> int:
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "DELETE FROM drafts WHERE expires_at <= ?", (time.time(),)
+            )
+        return cursor.rowcount
+
+    def stats(self) -> dict[str, int]:
+        with self._connection() as conn:
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM drafts "
+                "WHERE expires_at > ?",
+                (time.time(),),
+            ).fetchone()
+        return {"entries": entries, "bytes": size}
+
+
+def _payload(value: bytes | str) -> bytes:
+    # 新写入的是 BLOB；旧版本写入的 TEXT 行读出为 str
+    return value if isinstance(value, bytes) else value.encode("utf-8")
+
+
+def _dump(data: dict[str, Any] | bytes) -> bytes:
+    # bytes 视为调用方已校验并序列化好的 JSON，原样保存
+    return data if isinstance(data, bytes) else orjson.dumps(data)
+
+
+def _create_store() -> DraftStore:
+    if DRAFT_STORE == "sqlite":
+        return SqliteDraftStore(DRAFT_DB_PATH, DRAFT_TTL, DRAFT_DB_POOL_SIZE)
+    return MemoryDraftStore(DRAFT_TTL, DRAFT_MEMORY_BUDGET)
+
+
+_store = _create_store()
+
+
+def save_draft(data: dict[str, Any] | bytes) -> str:
     draft_id = uuid.uuid4().hex[:12]
-    _drafts[draft_id] = {
-        "data": data,
-        "created_at": time.time(),
-    }
+    _store.save(draft_id, _dump(data))
     return draft_id
 
 
+def update_draft(draft_id: str, data: dict[str, Any] | bytes):
+    # 覆盖原草稿并重新计算过期时间
+    _store.save(draft_id, _dump(data))
+
+
 def get_draft(draft_id: str) -> dict[str, Any] | None:
-    draft = _drafts.get(draft_id)
-    if draft is None:
-        return None
-    if time.time() - draft["created_at"] > DRAFT_TTL:
-        del _drafts[draft_id]
-        return None
-    return draft["data"]
+    payload = _store.get(draft_id)
+    return None if payload is None else orjson.loads(payload)
+
+
+def get_draft_bytes(draft_id: str) -> bytes | None:
+    return _store.get(draft_id)
+
+
+def modify_draft(
+    draft_id: str, update: Callable[[dict[str, Any]], dict[str, Any]]
+) -> dict[str, Any] | None:
+    # 读-改-写在存储内原子完成；update 抛出异常时草稿保持不变
+    result: dict[str, Any] | None = None
+
+    def apply(payload: bytes) -> bytes:
+        nonlocal result
+        result = update(orjson.loads(payload))
+        return orjson.dumps(result)
+
+    return result if _store.modify(draft_id, apply) else None
 
 
 def cleanup_expired() -> int:
-    now = time.time()
-    expired = [k for k, v in _drafts.items() if now - v["created_at"] > DRAFT_TTL]
-    for k in expired:
-        del _drafts[k]
-    return len(expired)
+    return _store.cleanup_expired()
+
+
+def draft_store_stats() -> dict[str, int]:
+    return _store.stats()
+
+
+async def run_draft_cleanup():
+    while True:
+        await asyncio.sleep(DRAFT_CLEANUP_INTERVAL)
+        await asyncio.to_thread(cleanup_expired)
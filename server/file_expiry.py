@@ -0,0 +1,114 @@
+import asyncio
+import heapq
+import threading
+import time
+from os import getenv
+from pathlib import Path
+
+from server.config import MEDIA_DIR, OUTPUT_DIR
+
+OUTPUT_TTL = int(getenv("OUTPUT_TTL", str(3600 * 24)))
+OUTPUT_MAX_BYTES = int(getenv("OUTPUT_MAX_BYTES", str(2 * 1024**3)))
+SWEEP_INTERVAL = int(getenv("OUTPUT_SWEEP_INTERVAL", "60"))
+# 卡片图片被草稿与后续导出引用，保留时间远长于生成文件；再次上传、访问或导出时续期
+MEDIA_TTL = int(getenv("MEDIA_TTL", str(3600 * 24 * 30)))
+MEDIA_MAX_BYTES = int(getenv("MEDIA_MAX_BYTES", str(1024**3)))
+
+TRACKED_PATTERNS = ("*.docx", "*.apkg", "*.zip", "*.json", "*.tmp")
+
+
+class ExpiryIndex:
+    """按到期时间排序的输出文件索引。
+
+    所有文件的存活时间相同，到期顺序即创建顺序，因此同一个堆也用于
+    超出磁盘配额时的最旧优先淘汰。重复登记的文件在堆中留有旧条目，
+    弹出时与 _entries 比对后跳过。
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        ttl: float,
+        max_bytes: int,
+        patterns: tuple[str, ...] = TRACKED_PATTERNS,
+    ):
+        self.directory = directory
+        self.patterns = patterns
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._heap: list[tuple[float, str]] = []
+        self._entries: dict[str, tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        with self._lock:
+            self._heap.clear()
+            self._entries.clear()
+            self.total_bytes = 0
+            for pattern in self.patterns:
+                for f in self.directory.glob(pattern):
+                    self._add(f)
+
+    def track(self, filename: str):
+        with self._lock:
+            self._add(self.directory / filename)
+
+    def _add(self, path: Path):
+        try:
+            stat_result = path.stat()
+        except FileNotFoundError:
+            return
+        self._discard(path.name)
+        deadline = stat_result.st_mtime + self.ttl
+        self._entries[path.name] = (deadline, stat_result.st_size)
+        self.total_bytes += stat_result.st_size
+        heapq.heappush(self._heap, (deadline, path.name))
+
+    def _discard(self, name: str):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def sweep(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            while self._heap:
+                deadline, name = self._heap[0]
+                entry = self._entries.get(name)
+                if entry is None or entry[0] != deadline:
+                    heapq.heappop(self._heap)
+                    continue
+                if deadline > now and self.total_bytes <= self.max_bytes:
+                    break
+                heapq.heappop(self._heap)
+                path = self.directory / name
+                # 文件在其他进程中被续期（mtime 更新）时按新的到期时间重新登记
+                try:
+                    renewed = path.stat().st_mtime + self.ttl > deadline
+                except FileNotFoundError:
+                    renewed = False
+                if renewed:
+                    self._add(path)
+                    continue
+                self._discard(name)
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+output_index = ExpiryIndex(OUTPUT_DIR, OUTPUT_TTL, OUTPUT_MAX_BYTES)
+media_index = ExpiryIndex(MEDIA_DIR, MEDIA_TTL, MEDIA_MAX_BYTES, ("*.*",))
+
+
+async def run_sweeper():
+    await asyncio.to_thread(output_index.rebuild)
+    await asyncio.to_thread(media_index.rebuild)
+    while True:
+        await asyncio.to_thread(output_index.sweep)
+        await asyncio.to_thread(media_index.sweep)
+        await asyncio.sleep(SWEEP_INTERVAL)
@@ -0,0 +1,429 @@
+import os
+import re
+import uuid
+from dataclasses import dataclass, field
+from functools import cache
+from math import ceil
+from pathlib import Path
+from multiprocessing.connection import Connection
+from typing import TYPE_CHECKING, Callable, Iterator, Literal
+
+from pydantic import BaseModel, Field, ValidationError
+
+from server.data_models import Chunk, ChunkDocument, group_by_level
+from server.media_store import extract_chunk_media, extract_media
+from server.metrics import collect_stages, stage
+
+# python-docx / genanki 只在工作进程中用到，在函数内导入，主进程启动时不加载
+if TYPE_CHECKING:
+    from docx.document import Document as DocumentClass
+
+FileType = Literal["docx", "apkg"]
+DocxEngine = Literal["python-docx", "ooxml"]
+FILE_TYPES: tuple[FileType, ...] = ("docx", "apkg")
+
+# 流式上传时工作进程等待下一批条目的最长秒数
+STREAM_IDLE_TIMEOUT = 60
+# 上传结束标记；未收到该标记而管道关闭表示上传被放弃
+STREAM_END = None
+
+
+class ExportOptions(BaseModel):
+    # Word 导出引擎：python-docx 对象模型 / 直接生成表格 OOXML（适合大卡组）
+    docx_engine: DocxEngine = "python-docx"
+    # 每卷 Word 文档最多的卡片行数，超出后拆分为多卷；None 表示不拆分
+    rows_per_volume: int | None = Field(default=None, ge=1)
+
+
+class ExportSpec(BaseModel):
+    document: ChunkDocument
+    options: ExportOptions = Field(default_factory=ExportOptions)
+
+
+class StreamHeader(BaseModel):
+    # NDJSON 上传的首行：ChunkDocument 除 records 外的字段
+    version: int
+    title: str
+    footer: str = Field(default="")
+    deckType: Literal["one-side", "two-sides", "type"] = Field(default="one-side")
+
+
+# docx_filename / apkg_filename；Word 分卷时另有 docx_volumes 列出各卷
+Filenames = dict[str, str | list[str]]
+
+
+@dataclass
+class BuildReport:
+    """工作进程的生成结果：文件名及各阶段耗时、文件大小，供主进程记录指标。"""
+
+    filenames: Filenames
+    chunks: int = 0
+    stages: dict[str, float] = field(default_factory=dict)
+    sizes: dict[str, int] = field(default_factory=dict)
+    # 工作进程中提取的图片文件名，过期索引在主进程中
+    media: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Volume:
+    """一卷 Word 文档：标题已带卷号，levels 为本卷各级别的条目。"""
+
+    document: ChunkDocument
+    levels: dict[str, list[Chunk]]
+    first_numbers: dict[str, int]
+    filename: str
+
+
+def volume_count(chunks: int, options: ExportOptions) -> int:
+    if options.rows_per_volume is None:
+        return 1
+    return max(1, ceil(chunks / options.rows_per_volume))
+
+
+def docx_filenames(file_id: str, volumes: int) -> list[str]:
+    if volumes == 1:
+        return [f"{file_id}.docx"]
+    return [f"{file_id}.vol{i}.docx" for i in range(1, volumes + 1)]
+
+
+def artifact_filenames(file_id: str, volumes: int = 1) -> Filenames:
+    docx = docx_filenames(file_id, volumes)
+    filenames: Filenames = {"docx_filename": docx[0], "apkg_filename": f"{file_id}.apkg"}
+    if volumes > 1:
+        filenames["docx_volumes"] = docx
+    return filenames
+
+
+def format_filenames(filenames: Filenames, file_type: FileType) -> Filenames:
+    return {k: v for k, v in filenames.items() if k.startswith(f"{file_type}_")}
+
+
+def artifact_files(filenames: Filenames) -> list[str]:
+    # 展开为全部文件名，分卷时 docx_filename 与第一卷相同
+    files = dict.fromkeys(
+        name
+        for value in filenames.values()
+        for name in ([value] if isinstance(value, str) else value)
+    )
+    return list(files)
+
+
+def plan_volumes(
+    document: ChunkDocument,
+    levels: dict[str, list[Chunk]],
+    file_id: str,
+    options: ExportOptions,
+) -> list[Volume]:
+    # 按级别顺序依次装满各卷；同一级别跨卷时，后一卷的序号接着前一卷
+    count = volume_count(sum(len(chunks) for chunks in levels.values()), options)
+    shell = document.model_copy(update={"records": []})
+    filenames = docx_filenames(file_id, count)
+    if count == 1:
+        return [Volume(shell, levels, {}, filenames[0])]
+
+    volumes = [
+        Volume(
+            shell.model_copy(update={"title": f"{document.title} ({i}/{count})"}),
+            {},
+            {},
+            filename,
+        )
+        for i, filename in enumerate(filenames, 1)
+    ]
+    capacity = options.rows_per_volume or 1
+    placed = 0
+    for level, chunks in sorted(levels.items(), key=lambda item: item[0]):
+        start = 0
+        while start < len(chunks):
+            volume = volumes[placed // capacity]
+            take = min(len(chunks) - start, capacity - placed % capacity)
+            volume.levels[level] = chunks[start : start + take]
+            volume.first_numbers[level] = start + 1
+            start += take
+            placed += take
+    return volumes
+
+
+def safe_title(title: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9\u4e00-\u9fa5_-]', '_', title)[:48]
+
+
+def spec_path(output_dir: Path, file_id: str) -> Path:
+    return output_dir / f"{file_id}.json"
+
+
+def warm_up():
+    # 工作进程启动时预先导入生成模块并构建文档骨架，首个请求不再承担这部分开销
+    import server.anki_utils
+    import server.ooxml_writer
+    from server.document_utils import document_skeleton
+
+    document_skeleton()
+
+
+def _level_tables(
+    levels: dict[str, list[Chunk]],
+    options: ExportOptions,
+    first_numbers: dict[str, int] | None = None,
+) -> Callable[["DocumentClass"], None]:
+    def generate(doc: "DocumentClass"):
+        from server.document_utils import generate_level_tables
+        from server.ooxml_writer import generate_level_tables_ooxml
+
+        if options.docx_engine == "ooxml":
+            generate_level_tables_ooxml(doc, levels, first_numbers)
+        else:
+            generate_level_tables(doc, levels, first_numbers)
+
+    return generate
+
+
+def _write_docx(
+    document: ChunkDocument,
+    file_path: Path,
+    generate_tables: Callable[["DocumentClass"], None],
+):
+    from server.document_utils import create_document, generate_footer
+
+    with stage("create_document"):
+        doc = create_document(document)
+    with stage("generate_tables"):
+        generate_tables(doc)
+    with stage("generate_footer"):
+        generate_footer(doc, document.footer)
+    with stage("save_docx"):
+        doc.save(str(file_path))
+
+
+@cache
+def _reference_document() -> "DocumentClass":
+    # 只读：为 OOXML 片段提供样式 ID 与页面尺寸
+    from server.document_utils import create_document
+
+    return create_document(ChunkDocument(version=4, records=[], title=""))
+
+
+def render_level_fragment(
+    level: str, chunks: list[Chunk], options: ExportOptions
+) -> tuple[str, dict[str, float]]:
+    # 并行导出时由各工作进程分别生成一个级别的 <w:body> 片段
+    from server.document_utils import level_fragment
+    from server.ooxml_writer import level_fragment_ooxml
+
+    with collect_stages() as stages:
+        with stage("render_level"):
+            if options.docx_engine == "ooxml":
+                fragment = level_fragment_ooxml(_reference_document(), level, chunks)
+            else:
+                fragment = level_fragment(level, chunks)
+    return fragment, stages
+
+
+def assemble_docx(
+    document: ChunkDocument, fragments: list[str], output_dir: Path, file_id: str
+) -> BuildReport:
+    # 按给定顺序拼接各级别片段；document 只需标题与页脚
+    from server.ooxml_writer import append_fragment
+
+    def generate_tables(doc: "DocumentClass"):
+        for fragment in fragments:
+            append_fragment(doc, fragment)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with collect_stages() as stages:
+        size = write_atomic(
+            output_dir,
+            f"{file_id}.docx",
+            lambda path: _write_docx(document, path, generate_tables),
+        )
+    return BuildReport({"docx_filename": f"{file_id}.docx"}, 0, stages, {"docx": size})
+
+
+def build_apkg(document: ChunkDocument, file_path: Path):
+    from server.anki_utils import gen_anki
+
+    with stage("gen_anki"):
+        gen_anki(document.records, document.deckType, file_path)
+
+
+def _write_volume(volume: Volume, output_dir: Path, options: ExportOptions) -> int:
+    generate_tables = _level_tables(volume.levels, options, volume.first_numbers)
+    return write_atomic(
+        output_dir,
+        volume.filename,
+        lambda path: _write_docx(volume.document, path, generate_tables),
+    )
+
+
+def build_docx_volume(
+    volume: Volume, output_dir: Path, options: ExportOptions
+) -> BuildReport:
+    # 分卷时各卷分别提交到进程池
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with collect_stages() as stages:
+        size = _write_volume(volume, output_dir, options)
+    return BuildReport({}, 0, stages, {"docx": size})
+
+
+def _build_format(
+    document: ChunkDocument,
+    output_dir: Path,
+    file_id: str,
+    file_type: FileType,
+    options: ExportOptions,
+) -> int:
+    # 返回写出文件的总大小（Word 分卷时为各卷之和）
+    if file_type == "docx":
+        volumes = plan_volumes(
+            document, group_by_level(document.records), file_id, options
+        )
+        return sum(_write_volume(volume, output_dir, options) for volume in volumes)
+    return write_atomic(
+        output_dir,
+        f"{file_id}.apkg",
+        lambda path: build_apkg(document, path),
+    )
+
+
+def temp_path(final_path: Path) -> Path:
+    # 临时文件名带进程号与随机后缀：多个 uvicorn worker 可能同时生成同一个延迟生成的文件，
+    # 各自写入不同的临时文件，最后的原子替换谁先谁后都得到完整文件
+    suffix = f"{os.getpid()}.{uuid.uuid4().hex[:8]}"
+    return final_path.with_name(f"{final_path.name}.{suffix}.tmp")
+
+
+def write_atomic(output_dir: Path, filename: str, write: Callable[[Path], None]) -> int:
+    # 先写入临时文件再替换，避免下载到写了一半的文件
+    final_path = output_dir / filename
+    tmp_path = temp_path(final_path)
+    try:
+        write(tmp_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    size = tmp_path.stat().st_size
+    tmp_path.replace(final_path)
+    return size
+
+
+def build_artifacts(
+    document: ChunkDocument, output_dir: Path, file_id: str, options: ExportOptions
+) -> BuildReport:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    volumes = volume_count(len(document.records), options)
+    report = BuildReport(artifact_filenames(file_id, volumes), len(document.records))
+    with collect_stages() as stages:
+        for file_type in FILE_TYPES:
+            report.sizes[file_type] = _build_format(
+                document, output_dir, file_id, file_type, options
+            )
+    report.stages = stages
+    return report
+
+
+def build_format(
+    document: ChunkDocument,
+    output_dir: Path,
+    file_id: str,
+    file_type: FileType,
+    options: ExportOptions,
+) -> BuildReport:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with collect_stages() as stages:
+        size = _build_format(document, output_dir, file_id, file_type, options)
+    volumes = volume_count(len(document.records), options)
+    return BuildReport(
+        format_filenames(artifact_filenames(file_id, volumes), file_type),
+        len(document.records),
+        stages,
+        {file_type: size},
+    )
+
+
+def merge_reports(reports: list[BuildReport], chunks: int) -> BuildReport:
+    merged = BuildReport({}, chunks)
+    for report in reports:
+        merged.filenames.update(report.filenames)
+        for file_type, size in report.sizes.items():
+            merged.sizes[file_type] = merged.sizes.get(file_type, 0) + size
+        for name, seconds in report.stages.items():
+            merged.stages[name] = merged.stages.get(name, 0.0) + seconds
+    return merged
+
+
+def build_from_spec(output_dir: Path, file_id: str, file_type: FileType) -> BuildReport:
+    with collect_stages() as stages:
+        with stage("load_spec"):
+            spec = ExportSpec.model_validate_json(
+                spec_path(output_dir, file_id).read_bytes()
+            )
+        size = _build_format(spec.document, output_dir, file_id, file_type, spec.options)
+    volumes = volume_count(len(spec.document.records), spec.options)
+    return BuildReport(
+        format_filenames(artifact_filenames(file_id, volumes), file_type),
+        len(spec.document.records),
+        stages,
+        {file_type: size},
+    )
+
+
+def _iter_stream(connection: Connection, media: set[str]) -> Iterator[Chunk]:
+    # 主进程只按行分帧，每行在这里校验一次；首行为文档头，条目从第 2 行开始
+    line_number = 1
+    while True:
+        if not connection.poll(STREAM_IDLE_TIMEOUT):
+            raise TimeoutError("Upload stalled")
+        try:
+            batch = connection.recv()
+        except EOFError:
+            raise RuntimeError("Upload aborted") from None
+        if batch is STREAM_END:
+            return
+        for line in batch:
+            line_number += 1
+            try:
+                chunk = Chunk.model_validate_json(line)
+            except ValidationError as e:
+                raise ValueError(f"Line {line_number}: {e}") from None
+            yield extract_chunk_media(chunk, media)
+
+
+def build_stream_artifacts(
+    header: StreamHeader,
+    connection: Connection,
+    output_dir: Path,
+    file_id: str,
+    options: ExportOptions,
+) -> BuildReport:
+    # 边接收边写入卡组：条目按批次从管道到达，直接插入 apkg 并按级别分组，
+    # 上传结束后再用分组结果生成 Word 文档
+    from server.anki_utils import gen_anki
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    media: set[str] = set()
+    header.footer = extract_media(header.footer, media)
+    document = ChunkDocument(records=[], **header.model_dump())
+    levels: dict[str, list[Chunk]] = {}
+
+    def grouped_chunks() -> Iterator[Chunk]:
+        for chunk in _iter_stream(connection, media):
+            levels.setdefault(chunk.level, []).append(chunk)
+            yield chunk
+
+    report = BuildReport({})
+    with connection, collect_stages() as stages:
+        with stage("gen_anki"):
+            report.sizes["apkg"] = write_atomic(
+                output_dir,
+                f"{file_id}.apkg",
+                lambda path: gen_anki(grouped_chunks(), header.deckType, path),
+            )
+        volumes = plan_volumes(document, levels, file_id, options)
+        report.sizes["docx"] = sum(
+            _write_volume(volume, output_dir, options) for volume in volumes
+        )
+    report.filenames = artifact_filenames(file_id, len(volumes))
+    report.chunks = sum(len(chunks) for chunks in levels.values())
+    report.stages = stages
+    report.media = sorted(media)
+    return report
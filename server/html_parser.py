@@ -1,16 +1,39 @@
+from functools import lru_cache
 from html.parser import HTMLParser
+from typing import NamedTuple
 from docx.document import Document as DocumentClass
-from docx.text.paragraph import Paragraph
 from docx.blkcntnr import BlockItemContainer
+from docx.image.image import Image
+from docx.shared import Cm
+
+from server.media_store import media_file, media_name, media_path
+
+# (粗体, 斜体, 下划线, 下标)
+RunStyle = tuple[bool, bool, bool, bool]
+TextRun = tuple[str, RunStyle]
+
+
+class Picture(NamedTuple):
+    # 媒体目录中的图片文件名
+    name: str
+
+
+CompiledHTML = tuple[tuple[TextRun | Picture, ...], ...]
+
+HTML_CACHE_SIZE = 8192
+# Word 能直接嵌入的图片格式；webp / svg 只随 Anki 卡组导出
+PICTURE_EXTENSIONS = ("png", "jpg", "gif", "bmp", "tiff")
+# 略小于正反面单元格宽度（8cm），更宽的图片等比缩小
+PICTURE_MAX_WIDTH = Cm(7.5)
 
 
 class HTMLToWordParser(HTMLParser):
-    def __init__(self, container: BlockItemContainer | DocumentClass):
+    def __init__(self):
         super().__init__()
         self.current_styles: list[dict[str, bool]] = []
-        self.container = container
-        self.paragraph_stack: list[Paragraph] = []
-        self.current_paragraph: Paragraph | None = None
+        self.paragraphs: list[list[TextRun | Picture]] = []
+        self.paragraph_stack: list[int] = []
+        self.current_paragraph: int | None = None
 
     def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
         style: dict[str, bool] = {}
@@ -24,15 +47,11 @@ class HTMLToWordParser(HTMLParser):
             style["subscript"] = True
         elif tag == "p":
             # 创建新段落并推入栈
-            if self.current_paragraph is None:
-                if isinstance(self.container, BlockItemContainer):
-                    new_paragraph = self.container.paragraphs[0]
-                else:
-                    new_paragraph = self.container.add_paragraph()
-            else:
-                new_paragraph = self.container.add_paragraph()
+            new_paragraph = self._add_paragraph()
             self.paragraph_stack.append(new_paragraph)
             self.current_paragraph = new_paragraph
+        elif tag == "img":
+            self._add_picture(dict(attrs).get("src") or "")
         self.current_styles.append(style)
 
     def handle_endtag(self, tag: str):
@@ -51,17 +70,75 @@ class HTMLToWordParser(HTMLParser):
         for style in reversed(self.current_styles):
             current_style.update(style)
         if self.current_paragraph is None:
-            if isinstance(self.container, BlockItemContainer):
-                self.current_paragraph = self.container.paragraphs[0]
-            else:
-                self.current_paragraph = self.container.add_paragraph()
-        run = self.current_paragraph.add_run(data)
-        run.font.bold = current_style.get("bold", False)
-        run.font.italic = current_style.get("italic", False)
-        run.font.underline = current_style.get("underline", False)
-        run.font.subscript = current_style.get("subscript", False)
+            self.current_paragraph = self._add_paragraph()
+        self.paragraphs[self.current_paragraph].append(
+            (
+                data,
+                (
+                    current_style.get("bold", False),
+                    current_style.get("italic", False),
+                    current_style.get("underline", False),
+                    current_style.get("subscript", False),
+                ),
+            )
+        )
+
+    def _add_picture(self, src: str):
+        # 只嵌入本服务媒体目录中的图片，外链忽略；编译结果会被缓存，
+        # 文件是否仍存在在写入 Word 时才检查
+        name = media_name(src)
+        if name is None or not name.endswith(PICTURE_EXTENSIONS):
+            return
+        if self.current_paragraph is None:
+            self.current_paragraph = self._add_paragraph()
+        self.paragraphs[self.current_paragraph].append(Picture(name))
+
+    def _add_paragraph(self) -> int:
+        self.paragraphs.append([])
+        return len(self.paragraphs) - 1
+
+    @classmethod
+    def compile(cls, html: str) -> CompiledHTML:
+        return compile_html(html)
 
     @classmethod
     def parse(cls, html: str, container: BlockItemContainer | DocumentClass):
-        parser = cls(container)
-        parser.feed(html)
\ No newline at end of file
+        for i, runs in enumerate(cls.compile(html)):
+            # 单元格自带一个空段落，第一段直接复用
+            if i == 0 and isinstance(container, BlockItemContainer):
+                paragraph = container.paragraphs[0]
+            else:
+                paragraph = container.add_paragraph()
+            for item in runs:
+                if isinstance(item, Picture):
+                    # python-docx 按内容摘要复用图片部件，同一图片只存一份；
+                    # 已被清理的图片跳过
+                    path = media_file(item.name)
+                    if path is not None:
+                        width, height = picture_size(item.name)
+                        paragraph.add_run().add_picture(
+                            str(path), width=width, height=height
+                        )
+                    continue
+                text, (bold, italic, underline, subscript) = item
+                run = paragraph.add_run(text)
+                run.font.bold = bold
+                run.font.italic = italic
+                run.font.underline = underline
+                run.font.subscript = subscript
+
+
+@lru_cache(maxsize=HTML_CACHE_SIZE)
+def compile_html(html: str) -> CompiledHTML:
+    # 编译为段落及其文本段描述，不依赖具体的 Word 容器；
+    # 结果为不可变元组，重复出现的片段（附加图标、常见释义等）直接复用
+    parser = HTMLToWordParser()
+    parser.feed(html)
+    return tuple(tuple(runs) for runs in parser.paragraphs)
+
+
+@lru_cache(maxsize=HTML_CACHE_SIZE)
+def picture_size(name: str) -> tuple[int, int]:
+    # 显示尺寸（EMU）：原始尺寸，超出单元格宽度时等比缩小
+    image = Image.from_file(str(media_path(name)))
+    return image.scaled_dimensions(min(image.width, PICTURE_MAX_WIDTH), None)
@@ -0,0 +1,513 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from os import cpu_count, getenv
+from typing import AsyncIterator, Callable, Literal
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from nanoid import generate
+
+from server.admission import (
+    Cost,
+    Ticket,
+    admission,
+    apkg_cost,
+    batch_cost,
+    document_cost,
+    payload_cost,
+)
+from server.artifact_cache import artifact_cache, document_fingerprint
+from server.config import OUTPUT_DIR
+from server.data_models import Chunk, ChunkDocument, group_by_level
+from server.file_expiry import media_index, output_index
+from server.metrics import merge_stages, record_build, stage
+from server.generation import (
+    BuildReport,
+    ExportOptions,
+    ExportSpec,
+    FileType,
+    Filenames,
+    STREAM_END,
+    StreamHeader,
+    artifact_filenames,
+    artifact_files,
+    assemble_docx,
+    build_artifacts,
+    build_docx_volume,
+    build_format,
+    build_from_spec,
+    build_stream_artifacts,
+    format_filenames,
+    merge_reports,
+    plan_volumes,
+    render_level_fragment,
+    spec_path,
+    volume_count,
+    warm_up,
+)
+
+GENERATION_WORKERS = int(getenv("GENERATION_WORKERS", "2"))
+JOB_TTL = 3600
+# 卡片条目数不少于此值且含多个级别时，Word 文档按级别拆分到多个工作进程并行生成
+PARALLEL_LEVELS_MIN_CHUNKS = int(getenv("PARALLEL_LEVELS_MIN_CHUNKS", "200"))
+# 单核机器上拆分只会增加进程间传输开销
+PARALLEL_LEVELS = GENERATION_WORKERS > 1 and (cpu_count() or 1) > 1
+# 流式上传的管道缓冲区大小（仅 Linux 可调），写满后暂停读取请求体
+STREAM_PIPE_BYTES = 1024**2
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+
+@dataclass
+class Job:
+    id: str
+    future: "Future[BuildReport]"
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def status(self) -> JobStatus:
+        if self.future.done():
+            if self.future.cancelled() or self.future.exception() is not None:
+                return "failed"
+            return "done"
+        if self.future.running():
+            return "running"
+        return "queued"
+
+    @property
+    def filenames(self) -> Filenames | None:
+        if self.status != "done":
+            return None
+        return self.future.result().filenames
+
+    @property
+    def error(self) -> str | None:
+        if self.status != "failed":
+            return None
+        if self.future.cancelled():
+            return "Job cancelled"
+        return str(self.future.exception())
+
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_coordinator: ThreadPoolExecutor | None = None
+_jobs: dict[str, Job] = {}
+_inflight: dict[str, Future] = {}
+_inflight_builds: dict[str, Future] = {}
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn 避免 fork 继承事件循环和线程状态
+            _executor = ProcessPoolExecutor(
+                max_workers=GENERATION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_up,
+            )
+        return _executor
+
+
+def _get_coordinator() -> ThreadPoolExecutor:
+    global _coordinator
+    with _executor_lock:
+        if _coordinator is None:
+            # 协调线程只负责向进程池分发任务并等待结果
+            _coordinator = ThreadPoolExecutor(
+                max_workers=GENERATION_WORKERS * 4, thread_name_prefix="generation"
+            )
+        return _coordinator
+
+
+def prestart_workers():
+    # 提前拉起全部工作进程（各自执行 warm_up），首个生成请求无需等待进程启动
+    for future in [_submit(warm_up) for _ in range(GENERATION_WORKERS)]:
+        future.result()
+
+
+def _new_stream_pipe() -> tuple[Connection, Connection]:
+    # 单向管道，条目直接从主进程传给工作进程，不经过中转进程
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    if hasattr(fcntl, "F_SETPIPE_SZ"):
+        try:
+            fcntl.fcntl(writer.fileno(), fcntl.F_SETPIPE_SZ, STREAM_PIPE_BYTES)
+        except OSError:
+            pass
+    return reader, writer
+
+
+def _submit(fn, *args) -> Future:
+    global _executor
+    try:
+        return _get_executor().submit(fn, *args)
+    except BrokenProcessPool:
+        # 工作进程异常退出后进程池不可再用，重建一次
+        with _executor_lock:
+            _executor = None
+        return _get_executor().submit(fn, *args)
+
+
+def _parallel_levels(document: ChunkDocument) -> dict[str, list[Chunk]] | None:
+    if not PARALLEL_LEVELS or len(document.records) < PARALLEL_LEVELS_MIN_CHUNKS:
+        return None
+    levels = group_by_level(document.records)
+    return levels if len(levels) > 1 else None
+
+
+def _parallel_volumes(document: ChunkDocument, options: ExportOptions) -> bool:
+    return PARALLEL_LEVELS and volume_count(len(document.records), options) > 1
+
+
+def _start_build(document: ChunkDocument, file_id: str, options: ExportOptions) -> Future:
+    if _parallel_volumes(document, options):
+        return _get_coordinator().submit(_build_volumes, document, file_id, options)
+    levels = _parallel_levels(document)
+    if levels is None:
+        return _submit(build_artifacts, document, OUTPUT_DIR, file_id, options)
+    return _get_coordinator().submit(_build_by_level, document, levels, file_id, options)
+
+
+def _build_by_level(
+    document: ChunkDocument,
+    levels: dict[str, list[Chunk]],
+    file_id: str,
+    options: ExportOptions,
+) -> BuildReport:
+    fragments = _submit_level_fragments(levels, options)
+    apkg = _submit(build_format, document, OUTPUT_DIR, file_id, "apkg", options)
+    docx = _assemble_levels(document, fragments, file_id)
+    return merge_reports([docx, apkg.result()], len(document.records))
+
+
+def _build_volumes(
+    document: ChunkDocument, file_id: str, options: ExportOptions
+) -> BuildReport:
+    apkg = _submit(build_format, document, OUTPUT_DIR, file_id, "apkg", options)
+    docx = _build_docx_volumes(document, file_id, options)
+    return merge_reports([docx, apkg.result()], len(document.records))
+
+
+def _build_docx_volumes(
+    document: ChunkDocument, file_id: str, options: ExportOptions
+) -> BuildReport:
+    # 各卷互不依赖，分别提交到进程池并行生成
+    volumes = plan_volumes(document, group_by_level(document.records), file_id, options)
+    futures = [_submit(build_docx_volume, volume, OUTPUT_DIR, options) for volume in volumes]
+    report = merge_reports([future.result() for future in futures], len(document.records))
+    report.filenames = format_filenames(artifact_filenames(file_id, len(volumes)), "docx")
+    return report
+
+
+def _submit_level_fragments(
+    levels: dict[str, list[Chunk]], options: ExportOptions
+) -> dict[str, Future]:
+    # 条目多的级别先提交，总耗时接近最大的级别
+    return {
+        level: _submit(render_level_fragment, level, chunks, options)
+        for level, chunks in sorted(levels.items(), key=lambda item: -len(item[1]))
+    }
+
+
+def _assemble_levels(
+    document: ChunkDocument, fragments: dict[str, Future], file_id: str
+) -> BuildReport:
+    # 等待全部片段后按级别顺序拼接为 Word 文档
+    results = [fragments[level].result() for level in sorted(fragments)]
+    report = _submit(
+        assemble_docx,
+        document.model_copy(update={"records": []}),
+        [fragment for fragment, _ in results],
+        OUTPUT_DIR,
+        file_id,
+    ).result()
+    fragment_reports = [BuildReport({}, 0, stages) for _, stages in results]
+    return merge_reports([report, *fragment_reports], len(document.records))
+
+
+def _build_from_spec(file_id: str, file_type: FileType) -> BuildReport:
+    if file_type == "docx" and PARALLEL_LEVELS:
+        spec = ExportSpec.model_validate_json(spec_path(OUTPUT_DIR, file_id).read_bytes())
+        if _parallel_volumes(spec.document, spec.options):
+            return _build_docx_volumes(spec.document, file_id, spec.options)
+        levels = _parallel_levels(spec.document)
+        if levels is not None:
+            fragments = _submit_level_fragments(levels, spec.options)
+            return _assemble_levels(spec.document, fragments, file_id)
+    return _submit(build_from_spec, OUTPUT_DIR, file_id, file_type).result()
+
+
+def _start_admitted(cost: Cost, start: Callable[[], Future]) -> Future:
+    # 占用名额后再提交；名额在任务结束（含失败、取消）时归还
+    ticket = admission.admit(cost)
+    try:
+        future = start()
+    except BaseException:
+        admission.release(ticket)
+        raise
+    future.add_done_callback(lambda f: admission.release(ticket))
+    return future
+
+
+def _prune_finished_jobs():
+    cutoff = time.time() - JOB_TTL
+    expired = [
+        k for k, v in _jobs.items() if v.future.done() and v.created_at < cutoff
+    ]
+    for k in expired:
+        del _jobs[k]
+
+
+def submit_generation(
+    document: ChunkDocument,
+    file_id: str | None = None,
+    options: ExportOptions | None = None,
+    admitted: bool = False,
+) -> Job:
+    # admitted：调用方已为本任务占用名额（整批导出），此处不再单独申请
+    _prune_finished_jobs()
+    options = options or ExportOptions()
+    key = document_fingerprint(document, options)
+
+    # 延迟记录的文件可能尚未生成，不能当作已完成的任务
+    cached = artifact_cache.get(key, built=True)
+    if cached is not None:
+        future: Future = Future()
+        future.set_result(BuildReport(cached, len(document.records)))
+    elif key in _inflight:
+        # 相同内容正在生成，复用同一个任务
+        future = _inflight[key]
+    else:
+        # 只有真正开始生成时才占用名额；命中缓存或复用在途任务不受限
+        file_id = file_id or generate()
+        if admitted:
+            future = _start_build(document, file_id, options)
+        else:
+            future = _start_admitted(
+                document_cost(document, options.rows_per_volume),
+                lambda: _start_build(document, file_id, options),
+            )
+        _inflight[key] = future
+        future.add_done_callback(lambda f: _on_generated(key, f))
+
+    job = Job(id=generate(), future=future)
+    _jobs[job.id] = job
+    return job
+
+
+def _on_generated(key: str, future: Future):
+    _inflight.pop(key, None)
+    if not future.cancelled() and future.exception() is None:
+        report = future.result()
+        record_build(report.stages, report.sizes, report.chunks)
+        for filename in artifact_files(report.filenames):
+            output_index.track(filename)
+        artifact_cache.put(key, report.filenames)
+
+
+async def run_generation(
+    document: ChunkDocument,
+    file_id: str | None = None,
+    options: ExportOptions | None = None,
+) -> Filenames:
+    job = submit_generation(document, file_id, options)
+    report = await _wait_for_build(job.future)
+    return report.filenames
+
+
+async def run_generation_batch(
+    documents: list[ChunkDocument], options: ExportOptions | None = None
+) -> list[Filenames]:
+    # 整批一次占用名额，全部文档结束后归还
+    ticket = admission.admit(batch_cost(documents, GENERATION_WORKERS))
+    futures: list[Future] = []
+    try:
+        for document in documents:
+            futures.append(submit_generation(document, None, options, admitted=True).future)
+    finally:
+        _release_when_done(ticket, futures)
+    reports = await asyncio.gather(*(_wait_for_build(future) for future in futures))
+    # 打包前确认每个文件都在磁盘上：缺失的格式（已被清理等）按记录补建
+    for report in reports:
+        for filename in artifact_files(report.filenames):
+            file_id, _, file_type = filename.rpartition(".")
+            if not await ensure_artifact(file_id, file_type):
+                raise FileNotFoundError(f"{filename} is no longer available")
+    return [report.filenames for report in reports]
+
+
+def _release_when_done(ticket: Ticket, futures: list[Future]):
+    remaining = len(futures)
+    lock = threading.Lock()
+
+    def on_done(_: Future):
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            finished = remaining == 0
+        if finished:
+            admission.release(ticket)
+
+    if not futures:
+        admission.release(ticket)
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+async def _wait_for_build(future: Future) -> BuildReport:
+    # shield：单个请求取消时不影响共享同一任务的其他请求
+    with stage("pool"):
+        report = await asyncio.shield(asyncio.wrap_future(future))
+    merge_stages(report.stages)
+    return report
+
+
+def record_document(
+    document: ChunkDocument,
+    file_id: str | None = None,
+    options: ExportOptions | None = None,
+) -> Filenames:
+    # 延迟生成：仅记录文档，各格式在首次下载时再构建
+    options = options or ExportOptions()
+    key = document_fingerprint(document, options)
+    cached = artifact_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # 不在此处生成，但当前无法完成的文档应立即拒绝，而不是等到下载时；
+    # 下载哪种格式尚未可知，按较便宜的 .apkg 检查，Word 文档在下载时按 Word 计价
+    admission.check(apkg_cost([document]))
+    file_id = file_id or generate()
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    path = spec_path(OUTPUT_DIR, file_id)
+    spec = ExportSpec(document=document, options=options)
+    path.write_text(spec.model_dump_json(), encoding="utf-8")
+    output_index.track(path.name)
+    filenames = artifact_filenames(file_id, volume_count(len(document.records), options))
+    artifact_cache.put(key, filenames, built=False)
+    return filenames
+
+
+def _on_built(key: str, future: Future):
+    _inflight_builds.pop(key, None)
+    if not future.cancelled() and future.exception() is None:
+        report = future.result()
+        record_build(report.stages, report.sizes, report.chunks)
+        for filename in artifact_files(report.filenames):
+            output_index.track(filename)
+
+
+async def ensure_artifact(file_id: str, file_type: FileType) -> bool:
+    # 分卷文件名形如 {id}.vol2.docx：按文档 ID 合并构建，一次生成全部分卷；
+    # 先查正在进行的构建，避免读到尚未写完其余分卷的结果
+    base_id = file_id.partition(".")[0]
+    key = f"{base_id}.{file_type}"
+    path = OUTPUT_DIR / f"{file_id}.{file_type}"
+    future = _inflight_builds.get(key)
+    if future is None:
+        if path.exists():
+            return True
+        spec = spec_path(OUTPUT_DIR, base_id)
+        if not spec.exists():
+            return False
+        future = _start_admitted(
+            payload_cost(spec.stat().st_size, file_type),
+            lambda: _get_coordinator().submit(_build_from_spec, base_id, file_type),
+        )
+        _inflight_builds[key] = future
+        future.add_done_callback(lambda f: _on_built(key, f))
+    await _wait_for_build(future)
+    return path.exists()
+
+
+async def run_stream_generation(
+    header: StreamHeader,
+    batches: AsyncIterator[list[bytes]],
+    file_id: str | None = None,
+    options: ExportOptions | None = None,
+    cost: Cost | None = None,
+) -> Filenames:
+    reader, writer = _new_stream_pipe()
+    file_id = file_id or generate()
+    options = options or ExportOptions()
+    try:
+        future = _start_admitted(
+            cost or payload_cost(0),
+            lambda: _submit(
+                build_stream_artifacts, header, reader, OUTPUT_DIR, file_id, options
+            ),
+        )
+    except BaseException:
+        reader.close()
+        writer.close()
+        raise
+    future.add_done_callback(_on_streamed)
+    # 读端传给工作进程后本进程的副本在任务结束时关闭，之后写入即报管道断开
+    future.add_done_callback(lambda _: reader.close())
+    # 写入与关闭都在同一个线程中依次执行，请求取消时不会在写入途中关闭管道
+    sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream-sender")
+    try:
+        async for batch in batches:
+            await _feed(sender, writer, batch, future)
+        await _feed(sender, writer, STREAM_END, future)
+    finally:
+        # 未发送结束标记就关闭：工作进程读到 EOF，放弃本次生成
+        sender.submit(writer.close)
+        sender.shutdown(wait=False)
+    report = await _wait_for_build(future)
+    return report.filenames
+
+
+async def _feed(sender: ThreadPoolExecutor, writer: Connection, item, future: Future):
+    # 管道写满时等待工作进程消费，形成背压；工作进程提前结束则直接抛出其异常
+    if not future.done():
+        try:
+            await asyncio.wrap_future(sender.submit(writer.send, item))
+            return
+        except OSError:
+            if not future.done():
+                raise
+    future.result()
+    raise RuntimeError("Generation finished before the upload ended")
+
+
+def _on_streamed(future: Future):
+    if not future.cancelled() and future.exception() is None:
+        report = future.result()
+        record_build(report.stages, report.sizes, report.chunks)
+        for filename in artifact_files(report.filenames):
+            output_index.track(filename)
+        for name in report.media:
+            media_index.track(name)
+
+
+async def run_in_pool(fn, *args, cost: Cost | None = None):
+    if cost is None:
+        future = _submit(fn, *args)
+    else:
+        future = _start_admitted(cost, lambda: _submit(fn, *args))
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+
+def get_job(job_id: str) -> Job | None:
+    return _jobs.get(job_id)
+
+
+def shutdown_executor():
+    global _executor, _coordinator
+    if _coordinator is not None:
+        _coordinator.shutdown(wait=False, cancel_futures=True)
+        _coordinator = None
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
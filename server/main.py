@@ -1,22 +1,86 @@
-import time
+import asyncio
+from contextlib import asynccontextmanager
 from os import getenv
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Response
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from nanoid import generate
+from pydantic_core import to_json
+
+from server.admission import AdmissionRejected, admission
+from server.artifact_cache import artifact_cache
+from server.batch import BatchRequest, run_batch
+from server.bundle import bundle_paths, iter_zip
+from server.config import OUTPUT_DIR
+from server.deck_sessions import is_internal_key
+from server.delta import DeltaRequest, run_delta
+from server.data_models import ChunkDocument
+from server.draft_patch import DraftPatch, apply_draft_patch, extract_patch_media
+from server.draft_store import (
+    save_draft,
+    get_draft_bytes,
+    modify_draft,
+    draft_store_stats,
+    run_draft_cleanup,
+)
+from server.file_expiry import output_index, run_sweeper
+from server.generation import FILE_TYPES, DocxEngine, ExportOptions, Filenames
+from server.jobs import (
+    Job,
+    JobStatus,
+    submit_generation,
+    run_generation,
+    record_document,
+    ensure_artifact,
+    get_job,
+    prestart_workers,
+    shutdown_executor,
+)
+from server.mcp_tools import LazyMCPApp
+from server.media_store import extract_document_media, is_media_name, media_file
+from server.streaming import run_stream
+from server.metrics import mark_since_start, render_metrics, stage, trace_request
 
-from mcp.server.transport_security import TransportSecuritySettings
+# 启动后在后台导入 MCP 并拉起生成进程；为 0 时均推迟到首次使用
+BACKGROUND_WARM_UP = getenv("BACKGROUND_WARM_UP", "1") != "0"
+
+mcp_app = LazyMCPApp()
+
+
+async def extract_request_media(documents: list[ChunkDocument]):
+    # 把内嵌的 data: 图片写入媒体目录；会写磁盘，放到线程中且只对通过校验的请求执行
+    with stage("extract_media"):
+        await asyncio.to_thread(lambda: [extract_document_media(d) for d in documents])
+
+
+async def warm_up_in_background():
+    await asyncio.to_thread(mcp_app.load)
+    await asyncio.to_thread(prestart_workers)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background_tasks = [
+        asyncio.create_task(run_sweeper()),
+        asyncio.create_task(run_draft_cleanup()),
+    ]
+    if BACKGROUND_WARM_UP:
+        background_tasks.append(asyncio.create_task(warm_up_in_background()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    shutdown_executor()
 
-from server.data_models import ChunkDocument
-from server.anki_utils import gen_anki
-from server.document_utils import create_document, generate_tables, generate_footer
-from server.draft_store import save_draft, get_draft
-from server.mcp_tools import register_tools
-from mcp.server.fastmcp import FastMCP
 
 app = FastAPI(
+    lifespan=lifespan,
     title="Anki Maker API",
     description="一个将文本内容转换为Anki卡片和Word文档的API服务",
     version="1.0.1",
@@ -39,92 +103,315 @@ app.add_middleware(
 )
 
 
-PRODUCTION = getenv("APP_ENV") == "production"
-
-
-def cleanup_old_files(max_age_hours: int = 24):
-    output_dir = Path("/app/output") if PRODUCTION else Path("./temp")
-    cutoff = time.time() - max_age_hours * 3600
-    for pattern in ("*.docx", "*.apkg"):
-        for f in output_dir.glob(pattern):
-            if f.stat().st_mtime < cutoff:
-                f.unlink(missing_ok=True)
+@app.middleware("http")
+async def trace_api_requests(request: Request, call_next):
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    with trace_request("unmatched") as trace:
+        try:
+            return await call_next(request)
+        finally:
+            # 路由匹配后 scope 中才有 endpoint，以处理函数名作为标签
+            endpoint = request.scope.get("endpoint")
+            if endpoint is not None:
+                trace.name = endpoint.__name__
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    # 过载返回 429 + Retry-After，超出单个文档的处理上限返回 413
+    return JSONResponse(
+        status_code=exc.status_code, content={"detail": str(exc)}, headers=exc.headers
+    )
 
 
 class DocumentResponse(BaseModel):
     message: str = "Documents generated successfully"
     docx_filename: str
     apkg_filename: str
+    # Word 拆分为多卷时的各卷文件名，docx_filename 为第一卷
+    docx_volumes: list[str] | None = None
+    bundle_url: str
+
+
+class BatchResponse(BaseModel):
+    message: str = "Batch generated successfully"
+    filename: str
+    documents: int
+
+
+class DeltaResponse(BaseModel):
+    apkg_filename: str | None
+    added: list[str]
+    modified: list[str]
+    removed: list[str]
+    manifest: dict[str, str]
+
+
+class JobResponse(BaseModel):
+    id: str
+    status: JobStatus
+    docx_filename: str | None = None
+    apkg_filename: str | None = None
+    docx_volumes: list[str] | None = None
+    bundle_url: str | None = None
+    error: str | None = None
+
+
+def _bundle_url(file_info: Filenames) -> str:
+    file_id = str(file_info["apkg_filename"]).rpartition(".")[0]
+    return f"/api/bundle/{file_id}"
+
+
+def _document_response(file_info: Filenames) -> DocumentResponse:
+    return DocumentResponse(**file_info, bundle_url=_bundle_url(file_info))
 
 
 @app.post(
     "/api/generate",
     response_model=DocumentResponse,
+    response_class=ORJSONResponse,
     summary="生成文档",
-    description="根据提供的内容生成Word文档(.docx)和Anki卡组(.apkg)文件",
+    description="根据提供的内容生成Word文档(.docx)和Anki卡组(.apkg)文件；"
+    "lazy=true 时仅记录文档，各文件在首次下载时生成；"
+    "docx_engine=ooxml 时直接生成表格XML，适合大卡组；"
+    "rows_per_volume 为每卷 Word 文档的最多行数，超出后拆分为多卷；"
+    "在途生成任务已满时返回 429 与 Retry-After",
 )
-async def generate_documents(request: ChunkDocument):
-    cleanup_old_files()
-    output_dir = Path("/app/output") if PRODUCTION else Path("./temp")
-    file_id = generate()
+async def generate_documents(
+    request: ChunkDocument,
+    lazy: bool = False,
+    docx_engine: DocxEngine = "python-docx",
+    rows_per_volume: int | None = Query(default=None, ge=1),
+):
+    mark_since_start("validate")
+    options = ExportOptions(docx_engine=docx_engine, rows_per_volume=rows_per_volume)
+    try:
+        await extract_request_media([request])
+        if lazy:
+            file_info = await asyncio.to_thread(record_document, request, None, options)
+        else:
+            file_info = await run_generation(request, None, options)
+        return _document_response(file_info)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.post(
+    "/api/generate/stream",
+    response_model=DocumentResponse,
+    response_class=ORJSONResponse,
+    summary="流式生成",
+    description="请求体为 NDJSON：首行为文档头(version/title/footer/deckType)，"
+    "其后每行一个卡片条目；边接收边校验并写入卡组，适合超大卡组",
+)
+async def generate_stream(
+    request: Request,
+    docx_engine: DocxEngine = "python-docx",
+    rows_per_volume: int | None = Query(default=None, ge=1),
+):
+    options = ExportOptions(docx_engine=docx_engine, rows_per_volume=rows_per_volume)
     try:
-        document = request
-        doc = create_document(document)
-        generate_tables(doc, document.records)
-        generate_footer(doc, document.footer)
-
-        docx_file_path = output_dir / f"{file_id}.docx"
-        doc.save(str(docx_file_path))
-
-        apkg_file_path = output_dir / f"{file_id}.apkg"
-        gen_anki(
-            document.records,
-            document.deckType,
-            apkg_file_path,
+        size = request.headers.get("content-length")
+        file_info = await run_stream(
+            request.stream(), options, int(size) if size and size.isdigit() else None
         )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return _document_response(file_info)
+
 
-        final_docx_path = Path(output_dir) / f"{file_id}.docx"
-        final_apkg_path = Path(output_dir) / f"{file_id}.apkg"
+@app.post(
+    "/api/jobs",
+    response_model=JobResponse,
+    summary="提交生成任务",
+    description="提交文档生成任务并立即返回任务ID，可通过 /api/jobs/{job_id} 查询进度",
+)
+async def submit_job(
+    request: ChunkDocument,
+    docx_engine: DocxEngine = "python-docx",
+    rows_per_volume: int | None = Query(default=None, ge=1),
+):
+    mark_since_start("validate")
+    options = ExportOptions(docx_engine=docx_engine, rows_per_volume=rows_per_volume)
+    await extract_request_media([request])
+    return _job_response(submit_generation(request, None, options))
 
-        docx_file_path.rename(final_docx_path)
-        apkg_file_path.rename(final_apkg_path)
 
-        return DocumentResponse(
-            message="Documents generated successfully",
-            docx_filename=f"{file_id}.docx",
-            apkg_filename=f"{file_id}.apkg",
-        )
+@app.post(
+    "/api/batch",
+    response_model=BatchResponse,
+    summary="批量生成",
+    description="一次导出多个文档：mode=apkg 生成一个含子卡组的 .apkg，"
+    "mode=zip 将各文档的 .docx/.apkg 打包为一个 .zip；通过 /api/download 下载",
+)
+async def generate_batch(request: BatchRequest):
+    mark_since_start("validate")
+    try:
+        await extract_request_media(request.documents)
+        filename = await run_batch(request)
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return BatchResponse(filename=filename, documents=len(request.documents))
+
+
+@app.post(
+    "/api/delta",
+    response_model=DeltaResponse,
+    summary="增量导出",
+    description="根据上次导出返回的清单，仅导出新增或修改的卡片为 .apkg（笔记GUID由卡片ID派生，"
+    "导入时更新原笔记）；返回新的清单供下次使用，无变化时 apkg_filename 为空",
+)
+async def generate_delta(request: DeltaRequest):
+    mark_since_start("validate")
+    try:
+        await extract_request_media([request.document])
+        result = await run_delta(request)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return DeltaResponse(**result)
 
 
 @app.get(
+    "/api/jobs/{job_id}",
+    response_model=JobResponse,
+    summary="查询生成任务",
+    description="查询生成任务状态(queued/running/done/failed)，完成后返回文件名",
+)
+async def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return _job_response(job)
+
+
+def _job_response(job: Job) -> JobResponse:
+    filenames = job.filenames
+    return JobResponse(
+        id=job.id,
+        status=job.status,
+        error=job.error,
+        bundle_url=_bundle_url(filenames) if filenames else None,
+        **(filenames or {}),
+    )
+
+
+@app.api_route(
     "/api/download/{file_type}/{filename}",
+    methods=["GET", "HEAD"],
     summary="下载文件",
-    description="下载之前生成的.docx或.apkg文件",
+    description="下载之前生成的.docx、.apkg或批量导出的.zip文件，支持 Range 断点续传与 ETag 缓存校验",
 )
-async def download_file(file_type: str, filename: str):
-    if file_type not in ["docx", "apkg"]:
+async def download_file(file_type: str, filename: str, request: Request):
+    if file_type not in ["docx", "apkg", "zip"]:
         raise HTTPException(status_code=400, detail="Invalid file type")
 
-    file_path = Path("/app/output" if PRODUCTION else "./temp") / filename
+    # 只提供与类型相符的生成文件，输出目录中的其他文件一律不可下载
+    if not filename.endswith(f".{file_type}"):
+        raise HTTPException(status_code=404, detail="File not found")
+    file_path = OUTPUT_DIR / filename
 
     if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")
+        file_id = filename.removesuffix(f".{file_type}")
+        if file_type not in FILE_TYPES:
+            raise HTTPException(status_code=404, detail="File not found")
+        try:
+            available = await ensure_artifact(file_id, file_type)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        if not available:
+            raise HTTPException(status_code=404, detail="File not found")
 
     media_types = {
         "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         "apkg": "application/octet-stream",
+        "zip": "application/zip",
     }
 
-    content = file_path.read_bytes()
-
-    return Response(
-        content=content,
+    # 从磁盘流式发送，Range/Content-Length/ETag 由 FileResponse 处理
+    response = FileResponse(
+        file_path,
         media_type=media_types[file_type],
-        headers={"Content-Disposition": "attachment"},
+        filename=filename,
+        stat_result=file_path.stat(),
     )
+    if _etag_matches(request.headers.get("if-none-match"), response.headers["etag"]):
+        return Response(status_code=304, headers={"ETag": response.headers["etag"]})
+    return response
+
+
+@app.get(
+    "/api/bundle/{file_id}",
+    summary="打包下载",
+    description="将同一次导出的Word文档（含全部分卷）与Anki卡组边读边打包为一个.zip流式返回，"
+    "服务器上不生成压缩文件",
+)
+async def download_bundle(file_id: str):
+    if "." in file_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    paths = await asyncio.to_thread(bundle_paths, OUTPUT_DIR, file_id)
+    missing = [file_type for file_type, found in paths.items() if not found]
+    if missing:
+        # 延迟生成的文档先补齐缺少的格式
+        try:
+            for file_type in missing:
+                await ensure_artifact(file_id, file_type)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        paths = await asyncio.to_thread(bundle_paths, OUTPUT_DIR, file_id)
+    files = [path for found in paths.values() for path in found]
+    if not files:
+        raise HTTPException(status_code=404, detail="File not found")
+    return StreamingResponse(
+        iter_zip(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{file_id}.zip"'},
+    )
+
+
+@app.get(
+    "/api/media/{name}",
+    summary="获取卡片图片",
+    description="获取从卡片HTML中提取的图片；文件名为内容的SHA-256，访问时续期",
+)
+async def get_media(name: str):
+    # 被访问的图片同时续期，在线编辑中仍在使用的图片不会过期
+    path = media_file(name) if is_media_name(name) else None
+    if path is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    # 浏览器缓存期限短于 MEDIA_TTL，编辑页打开期间的重新验证会让图片持续续期；
+    # 图片来自用户上传，禁止浏览器按内容猜测类型，并以沙箱方式打开，不能在本站执行脚本
+    return FileResponse(
+        path,
+        headers={
+            "Cache-Control": "public, max-age=86400",
+            "X-Content-Type-Options": "nosniff",
+            "Content-Security-Policy": "sandbox",
+        },
+    )
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag in tags
 
 
 @app.get("/api/", summary="API根路径", description="检查API是否正在运行")
@@ -132,13 +419,46 @@ async def root():
     return {"message": "Anki Maker API is running"}
 
 
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    # 容器健康检查：不经过请求追踪，也不触发任何延迟加载
+    return PlainTextResponse("ok")
+
+
+@app.get(
+    "/api/metrics",
+    response_class=PlainTextResponse,
+    summary="运行指标",
+    description="Prometheus 文本格式的指标：请求与生成各阶段耗时、卡片条目数、文件大小、"
+    "草稿存储与输出目录占用",
+)
+async def metrics():
+    drafts = await asyncio.to_thread(draft_store_stats)
+    inflight, inflight_bytes = admission.stats()
+    gauges = [
+        ("anki_maker_draft_entries", "草稿数量", drafts["entries"]),
+        ("anki_maker_draft_bytes", "草稿存储占用字节数", drafts["bytes"]),
+        ("anki_maker_output_files", "输出目录文件数", len(output_index)),
+        ("anki_maker_output_bytes", "输出目录占用字节数", output_index.total_bytes),
+        ("anki_maker_artifact_cache_entries", "生成结果缓存条目数", len(artifact_cache)),
+        ("anki_maker_admission_inflight", "在途生成任务数", inflight),
+        ("anki_maker_admission_bytes", "在途生成任务的估算内存", inflight_bytes),
+    ]
+    return PlainTextResponse(
+        render_metrics(gauges), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.post(
     "/api/drafts",
     summary="保存草稿",
     description="保存卡片数据为草稿，返回可编辑的草稿ID",
 )
 async def save_draft_endpoint(request: ChunkDocument):
-    draft_id = save_draft(request.model_dump())
+    # 直接序列化为 JSON 字节保存，读取时原样返回；
+    # SQLite 存储可能要等其他 worker 释放写锁，草稿读写都放到线程中，不阻塞事件循环
+    await extract_request_media([request])
+    draft_id = await asyncio.to_thread(save_draft, to_json(request))
     return {"id": draft_id, "edit_url": f"/edit/{draft_id}"}
 
 
@@ -148,20 +468,40 @@ async def save_draft_endpoint(request: ChunkDocument):
     description="通过草稿ID获取之前保存的卡片数据",
 )
 async def get_draft_endpoint(draft_id: str):
-    data = get_draft(draft_id)
-    if data is None:
+    if is_internal_key(draft_id):
         raise HTTPException(status_code=404, detail="Draft not found or expired")
-    return data
+    payload = await asyncio.to_thread(get_draft_bytes, draft_id)
+    if payload is None:
+        raise HTTPException(status_code=404, detail="Draft not found or expired")
+    return Response(payload, media_type="application/json")
 
 
-mcp_server = FastMCP(
-    "Anki Maker",
-    transport_security=TransportSecuritySettings(
-        enable_dns_rebinding_protection=False
-    ),
+@app.patch(
+    "/api/drafts/{draft_id}",
+    summary="增量更新草稿",
+    description="按卡片ID新增/替换、删除或重排卡片，并可修改标题、页脚与卡组类型",
 )
-register_tools(mcp_server)
-app.mount("/mcp", mcp_server.sse_app())
+async def patch_draft_endpoint(draft_id: str, patch: DraftPatch):
+    if is_internal_key(draft_id):
+        raise HTTPException(status_code=404, detail="Draft not found or expired")
+    await asyncio.to_thread(extract_patch_media, patch)
+    # 在存储内原子地读-改-写，多个 worker 并发修改同一草稿时不会丢失更新
+    try:
+        data = await asyncio.to_thread(
+            modify_draft, draft_id, lambda data: apply_draft_patch(data, patch)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if data is None:
+        raise HTTPException(status_code=404, detail="Draft not found or expired")
+    return {
+        "id": draft_id,
+        "edit_url": f"/edit/{draft_id}",
+        "records": len(data["records"]),
+    }
+
+
+app.mount("/mcp", mcp_app)
 
 
 @app.get('/')
@@ -1,87 +1,115 @@
-import re
-from os import getenv
-from pathlib import Path
-from typing import Annotated, Literal
+import asyncio
+import threading
+from os import getenv, urandom
+from typing import Annotated, Any, Literal
 
 from pydantic import Field
 
-from server.data_models import Chunk, Addition, ChunkDocument
+from server.data_models import ChunkDocument
+from server.deck_sessions import (
+    append_batch,
+    assemble_session,
+    open_session,
+    replace_records,
+)
 from server.draft_store import save_draft
-from server.anki_utils import gen_anki
-from server.document_utils import create_document, generate_tables, generate_footer
-from server.tool_inputs import ChunkInput
+from server.generation import Filenames, safe_title
+from server.jobs import run_generation, record_document
+from server.media_store import extract_media
+from server.metrics import stage, trace_request
+from server.tool_inputs import ChunkInput, ChunkUpdate
 from nanoid import generate
-
-
-def _make_chunk_document(
+from nanoid.resources import alphabet as ID_ALPHABET, size as ID_SIZE
+
+# 随机字节到 nanoid 字母表的映射；字母表恰为 64 个字符，取低 6 位即与 nanoid 分布一致
+_ID_TABLE = bytes(ord(ID_ALPHABET[b & 63]) for b in range(256))
+
+DeckType = Annotated[
+    Literal["one-side", "two-sides", "type"],
+    Field(description="单面(单向记忆) / 双面(双向记忆) / 输入(自我检测)"),
+]
+
+
+def _allocate_ids(count: int) -> list[str]:
+    # 一次取出全部随机字节，避免逐个调用 nanoid.generate()
+    raw = urandom(count * ID_SIZE).translate(_ID_TABLE).decode("ascii")
+    return [raw[i : i + ID_SIZE] for i in range(0, len(raw), ID_SIZE)]
+
+
+def _chunk_records(
+    chunks: list[ChunkInput], card_ids: list[str] | None = None
+) -> list[dict[str, Any]]:
+    # 直接拼出草稿格式的字典：既交给 ChunkDocument 一次性校验，也原样存为草稿，
+    # 不再逐个构造模型后再 model_dump；card_ids 为替换卡片时沿用的 ID。
+    # 内嵌图片在此提取到媒体目录，会写磁盘，调用方应在线程中执行
+    additions = sum(len(c.additions) for c in chunks)
+    ids = iter(_allocate_ids(additions + (0 if card_ids else len(chunks))))
+    if card_ids is None:
+        card_ids = [next(ids) for _ in chunks]
+    return [
+        {
+            "id": card_id,
+            "level": c.level,
+            "front": extract_media(c.front),
+            "back": extract_media(c.back),
+            "additions": [
+                {
+                    "id": next(ids),
+                    "icon": a.icon,
+                    "front": extract_media(a.front),
+                    "back": extract_media(a.back),
+                }
+                for a in c.additions
+            ],
+        }
+        for card_id, c in zip(card_ids, chunks)
+    ]
+
+
+def _document_data(
     chunks: list[ChunkInput],
     title: str = "",
     footer: str = "",
     deck_type: str = "one-side",
-) -> ChunkDocument:
-    records = []
-    for c in chunks:
-        additions = [
-            Addition(
-                id=generate(),
-                icon=a.icon,
-                front=a.front,
-                back=a.back,
-            )
-            for a in c.additions
-        ]
-        records.append(
-            Chunk(
-                id=generate(),
-                level=c.level,
-                front=c.front,
-                back=c.back,
-                additions=additions,
-            )
-        )
-    return ChunkDocument(
-        version=4,
-        records=records,
-        title=title or "Untitled",
-        footer=footer,
-        deckType=deck_type,
-    )
-
-
-def generate_files(document: ChunkDocument) -> dict[str, str]:
-    from server.main import PRODUCTION
-
-    output_dir = Path("/app/output") if PRODUCTION else Path("./temp")
-    output_dir.mkdir(parents=True, exist_ok=True)
-    safe_title = re.sub(r'[^a-zA-Z0-9\u4e00-\u9fa5_-]', '_', document.title)[:48]
-    file_id = safe_title + "_" + __import__('nanoid').generate()
-
-    doc = create_document(document)
-    generate_tables(doc, document.records)
-    generate_footer(doc, document.footer)
-
-    docx_path = output_dir / f"{file_id}.docx"
-    doc.save(str(docx_path))
-
-    apkg_path = output_dir / f"{file_id}.apkg"
-    gen_anki(document.records, document.deckType, apkg_path)
-
+) -> dict[str, Any]:
     return {
-        "docx_filename": f"{file_id}.docx",
-        "apkg_filename": f"{file_id}.apkg",
+        "version": 4,
+        "records": _chunk_records(chunks),
+        "title": title or "Untitled",
+        "footer": extract_media(footer),
+        "deckType": deck_type,
     }
 
 
+async def generate_files(document: ChunkDocument, lazy: bool = False) -> Filenames:
+    file_id = safe_title(document.title) + "_" + generate()
+    if lazy:
+        with stage("record_document"):
+            return await asyncio.to_thread(record_document, document, file_id)
+    return await run_generation(document, file_id)
+
+
+def _files_message(document: ChunkDocument, file_info: Filenames, draft_id: str) -> str:
+    base_url = getenv("API_BASE_URL", "http://localhost:4134")
+    return (
+        f"Cards generated successfully!\n\n"
+        f"- Title: {document.title}\n"
+        f"- Cards: {len(document.records)}\n"
+        f"- Deck type: {document.deckType}\n\n"
+        f"Links:\n"
+        f"- Edit online: {base_url}/edit/{draft_id}\n"
+        f"- Download Word: {base_url}/api/download/docx/{file_info['docx_filename']}\n"
+        f"- Download Anki: {base_url}/api/download/apkg/{file_info['apkg_filename']}"
+    )
+
+
 def register_tools(mcp):
     @mcp.tool()
     async def generate_flashcards(
         chunks: list[ChunkInput],
         title: str = "",
         footer: str = "",
-        deck_type: Annotated[
-            Literal["one-side", "two-sides", "type"],
-            Field(description="单面(单向记忆) / 双面(双向记忆) / 输入(自我检测)"),
-        ] = "one-side",
+        deck_type: DeckType = "one-side",
     ) -> str:
         """Generate Anki flashcards (.apkg) and Word document (.docx) from card data.
 
@@ -89,20 +117,108 @@ def register_tools(mcp):
         and optional example sentences (additions). Returns downloadable file
         links and an editable URL for further modification.
         """
-        document = _make_chunk_document(chunks, title, footer, deck_type)
-        file_info = generate_files(document)
-        draft_id = save_draft(document.model_dump())
-        base_url = getenv("API_BASE_URL", "http://localhost:4134")
-
-        return (
-            f"Cards generated successfully!\n\n"
-            f"- Title: {document.title}\n"
-            f"- Cards: {len(document.records)}\n"
-            f"- Deck type: {document.deckType}\n\n"
-            f"Links:\n"
-            f"- Edit online: {base_url}/edit/{draft_id}\n"
-            f"- Download Word: {base_url}/api/download/docx/{file_info['docx_filename']}\n"
-            f"- Download Anki: {base_url}/api/download/apkg/{file_info['apkg_filename']}"
-        )
+        with trace_request("mcp.generate_flashcards"):
+            with stage("validate"):
+                data = await asyncio.to_thread(
+                    _document_data, chunks, title, footer, deck_type
+                )
+                document = ChunkDocument.model_validate(data)
+            # 返回的是下载链接，文件在首次下载时再生成
+            file_info = await generate_files(document, lazy=True)
+            with stage("save_draft"):
+                draft_id = await asyncio.to_thread(save_draft, data)
+        return _files_message(document, file_info, draft_id)
+
+    @mcp.tool()
+    async def open_deck(
+        title: str = "", footer: str = "", deck_type: DeckType = "one-side"
+    ) -> str:
+        """Start building a large deck in batches instead of one huge call.
+
+        Returns a deck_id. Add cards with add_cards (e.g. 50-100 per call),
+        correct cards with replace_cards, then call finalize_deck once to get
+        the download links.
+        """
+        with trace_request("mcp.open_deck"):
+            deck_id = await asyncio.to_thread(
+                lambda: open_session(title, extract_media(footer), deck_type)
+            )
+        return f"Deck opened. deck_id: {deck_id}"
+
+    @mcp.tool()
+    async def add_cards(deck_id: str, chunks: list[ChunkInput]) -> str:
+        """Append a batch of flashcards to a deck opened with open_deck.
+
+        Returns the ids of the new cards in order; pass them to replace_cards
+        to change a card later.
+        """
+        with trace_request("mcp.add_cards"):
+            with stage("validate"):
+                records = await asyncio.to_thread(_chunk_records, chunks)
+            with stage("save_draft"):
+                ids, total = await asyncio.to_thread(append_batch, deck_id, records)
+        return f"Added {len(ids)} cards (deck total: {total}).\nCard ids: {', '.join(ids)}"
+
+    @mcp.tool()
+    async def replace_cards(deck_id: str, cards: list[ChunkUpdate]) -> str:
+        """Replace existing cards of an open deck by id, keeping their position."""
+        with trace_request("mcp.replace_cards"):
+            with stage("validate"):
+                records = await asyncio.to_thread(
+                    _chunk_records, cards, [card.id for card in cards]
+                )
+            with stage("save_draft"):
+                await asyncio.to_thread(replace_records, deck_id, records)
+        return f"Replaced {len(records)} cards."
+
+    @mcp.tool()
+    async def finalize_deck(deck_id: str) -> str:
+        """Build the Anki deck (.apkg) and Word document (.docx) for an open deck.
+
+        Returns download links and an editable URL. More cards can still be
+        added afterwards; call finalize_deck again for updated files.
+        """
+        with trace_request("mcp.finalize_deck"):
+            with stage("save_draft"):
+                data = await asyncio.to_thread(assemble_session, deck_id)
+            if not data["records"]:
+                raise ValueError("Deck has no cards; add some with add_cards first")
+            with stage("validate"):
+                document = ChunkDocument.model_validate(data)
+            file_info = await generate_files(document, lazy=True)
+        return _files_message(document, file_info, deck_id)
 
     return mcp
+
+
+def create_mcp_app():
+    # MCP/FastMCP 导入耗时约占服务启动的一半，首次访问 /mcp 或后台预热时才构建
+    from mcp.server.fastmcp import FastMCP
+    from mcp.server.transport_security import TransportSecuritySettings
+
+    mcp_server = FastMCP(
+        "Anki Maker",
+        transport_security=TransportSecuritySettings(
+            enable_dns_rebinding_protection=False
+        ),
+    )
+    register_tools(mcp_server)
+    return mcp_server.sse_app()
+
+
+class LazyMCPApp:
+    """挂载到 /mcp 的 ASGI 应用，首次使用时才构建 MCP 的 SSE 应用。"""
+
+    def __init__(self):
+        self._app = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._app is None:
+                self._app = create_mcp_app()
+            return self._app
+
+    async def __call__(self, scope, receive, send):
+        app = self._app or await asyncio.to_thread(self.load)
+        await app(scope, receive, send)
@@ -0,0 +1,146 @@
+import base64
+import binascii
+import hashlib
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable
+
+from server.config import MEDIA_DIR
+from server.file_expiry import media_index
+
+if TYPE_CHECKING:
+    from server.data_models import Chunk, ChunkDocument
+
+# 卡片 HTML 中以 data: URI 内嵌的图片提取到按内容寻址的媒体目录，文件名为 sha256 + 扩展名；
+# HTML 中改为引用 /api/media/{文件名}，在线编辑页可直接显示，导出 Anki 时再换成文件名。
+# 提取会写磁盘，由接口在校验之后、事件循环之外显式调用，不作为模型校验的副作用。
+
+MEDIA_URL_PREFIX = "/api/media/"
+
+# 声明的类型只用于初筛，实际格式由文件头判断；SVG 可内嵌脚本，不提取
+MEDIA_TYPES = {
+    "image/png",
+    "image/jpeg",
+    "image/jpg",
+    "image/gif",
+    "image/bmp",
+    "image/tiff",
+}
+
+DATA_URI = re.compile(
+    r"""(?P<src>\bsrc\s*=\s*)(?P<quote>["']?)"""
+    r"data:(?P<type>image/[\w.+-]+);base64,(?P<data>[A-Za-z0-9+/=\s]+)(?P=quote)",
+    re.IGNORECASE,
+)
+MEDIA_NAME = re.compile(r"[0-9a-f]{64}\.[a-z]+")
+MEDIA_REF = re.compile(
+    r"""(?P<src>\bsrc\s*=\s*["']?)"""
+    + re.escape(MEDIA_URL_PREFIX)
+    + r"(?P<name>[0-9a-f]{64}\.[a-z]+)"
+)
+
+
+def is_media_name(name: str) -> bool:
+    return MEDIA_NAME.fullmatch(name) is not None
+
+
+def media_name(src: str) -> str | None:
+    # <img src> 引用的媒体文件名；不是本服务的媒体链接时返回 None
+    name = src.removeprefix(MEDIA_URL_PREFIX)
+    return name if name != src and is_media_name(name) else None
+
+
+def media_path(name: str) -> Path:
+    return MEDIA_DIR / name
+
+
+def media_file(name: str) -> Path | None:
+    # 取用时续期：仍被草稿或导出引用的图片不会因 MEDIA_TTL 到期被清理
+    path = media_path(name)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def store_media(data: bytes, extension: str) -> str:
+    name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+    path = media_path(name)
+    if media_file(name) is None:
+        # 临时文件名唯一：多个线程或 worker 可能同时写入同一张图片
+        MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f"{name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+        temp.write_bytes(data)
+        os.replace(temp, path)
+    media_index.track(name)
+    return name
+
+
+def _image_extension(data: bytes) -> str | None:
+    # 只提取 Word 能嵌入的图片：python-docx 无法解析的数据（截断、格式与声明不符等）
+    # 一旦入库，之后每次导出 Word 都会失败；扩展名以实际格式为准
+    from docx.image.image import Image
+
+    try:
+        return Image.from_blob(data).ext
+    except Exception:
+        return None
+
+
+def _replace_data_uri(match: re.Match, stored: set[str] | None) -> str:
+    # 不能提取的图片保留原 data: URI：Anki 仍可显示，导出 Word 时忽略
+    if match["type"].lower() not in MEDIA_TYPES:
+        return match[0]
+    try:
+        data = base64.b64decode(re.sub(r"\s+", "", match["data"]), validate=True)
+    except binascii.Error:
+        return match[0]
+    extension = _image_extension(data)
+    if extension is None:
+        return match[0]
+    quote = match["quote"]
+    name = store_media(data, extension)
+    if stored is not None:
+        stored.add(name)
+    return f"{match['src']}{quote}{MEDIA_URL_PREFIX}{name}{quote}"
+
+
+def extract_media(html: str, stored: set[str] | None = None) -> str:
+    # 传入 stored 时收集写入的文件名：在工作进程中提取时，由主进程登记到过期索引
+    # 绝大多数字段不含图片，先做廉价的子串判断
+    if "data:" not in html:
+        return html
+    return DATA_URI.sub(lambda match: _replace_data_uri(match, stored), html)
+
+
+def extract_chunk_media(chunk: "Chunk", stored: set[str] | None = None) -> "Chunk":
+    chunk.front = extract_media(chunk.front, stored)
+    chunk.back = extract_media(chunk.back, stored)
+    for addition in chunk.additions:
+        addition.front = extract_media(addition.front, stored)
+        addition.back = extract_media(addition.back, stored)
+    return chunk
+
+
+def extract_document_media(document: "ChunkDocument") -> "ChunkDocument":
+    for chunk in document.records:
+        extract_chunk_media(chunk)
+    document.footer = extract_media(document.footer)
+    return document
+
+
+def anki_field(html: str, names: set[str]) -> str:
+    # Anki 按文件名在 collection.media 中查找图片：去掉链接前缀，并收集引用的文件名
+    def replace(match: re.Match) -> str:
+        names.add(match["name"])
+        return f"{match['src']}{match['name']}"
+
+    return MEDIA_REF.sub(replace, html) if MEDIA_URL_PREFIX in html else html
+
+
+def existing_media(names: Iterable[str]) -> list[Path]:
+    # 图片可能已过期被清理，导出时跳过缺失的文件
+    return [path for name in sorted(names) if (path := media_file(name)) is not None]
@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from os import getenv
+
+# 请求总耗时超过该秒数时记录各阶段耗时，0 表示关闭
+SLOW_REQUEST_SECONDS = float(getenv("SLOW_REQUEST_SECONDS", "0"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CHUNK_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 50000)
+SIZE_BUCKETS = (16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20)
+
+logger = logging.getLogger("anki_maker.slow_requests")
+
+
+class Histogram:
+    """Prometheus 直方图，最多一个标签。"""
+
+    def __init__(self, name: str, help: str, buckets: tuple, label: str = ""):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        # 标签值 -> [各桶计数..., +Inf 计数], 总和
+        self._series: dict[str, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label_value: str = ""):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.setdefault(
+                label_value, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: (list(c), t[0]) for k, (c, t) in self._series.items()}
+        for label_value, (counts, total) in sorted(series.items()):
+            prefix = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            labels = f"{{{prefix[:-1]}}}" if prefix else ""
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+request_duration = Histogram(
+    "anki_maker_request_duration_seconds", "请求处理耗时", LATENCY_BUCKETS, "endpoint"
+)
+stage_duration = Histogram(
+    "anki_maker_stage_duration_seconds", "生成各阶段耗时", LATENCY_BUCKETS, "stage"
+)
+document_chunks = Histogram(
+    "anki_maker_document_chunks", "每次生成的卡片条目数", CHUNK_BUCKETS
+)
+artifact_bytes = Histogram(
+    "anki_maker_artifact_bytes", "生成文件大小", SIZE_BUCKETS, "file_type"
+)
+HISTOGRAMS = (request_duration, stage_duration, document_chunks, artifact_bytes)
+
+
+@dataclass
+class Trace:
+    name: str = ""
+    started: float = field(default_factory=time.perf_counter)
+    stages: dict[str, float] = field(default_factory=dict)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+@contextmanager
+def collect_stages():
+    # 工作进程内收集各阶段耗时，随生成结果一起返回主进程
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace.stages
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_duration.observe(elapsed, name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+
+def mark_since_start(name: str):
+    # 以请求开始到此刻的耗时记为一个阶段（用于请求体读取与校验）
+    trace = _current_trace.get()
+    if trace is not None:
+        elapsed = time.perf_counter() - trace.started
+        stage_duration.observe(elapsed, name)
+        trace.add(name, elapsed)
+
+
+def merge_stages(stages: dict[str, float]):
+    # 工作进程的阶段已在 record_build 中计入直方图，这里只并入当前请求的明细
+    trace = _current_trace.get()
+    if trace is not None:
+        for name, seconds in stages.items():
+            trace.add(name, seconds)
+
+
+def record_build(stages: dict[str, float], sizes: dict[str, int], chunks: int):
+    for name, seconds in stages.items():
+        stage_duration.observe(seconds, name)
+    for file_type, size in sizes.items():
+        artifact_bytes.observe(size, file_type)
+    document_chunks.observe(chunks)
+
+
+@contextmanager
+def trace_request(name: str = ""):
+    trace = Trace(name=name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        elapsed = time.perf_counter() - trace.started
+        request_duration.observe(elapsed, trace.name)
+        if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+            breakdown = " ".join(f"{k}={v:.3f}s" for k, v in trace.stages.items())
+            logger.warning(
+                "slow request %s %.3fs %s",
+                trace.name,
+                elapsed,
+                breakdown or "-",
+            )
+
+
+def render_metrics(gauges: list[tuple[str, str, float]]) -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for name, help, value in gauges:
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
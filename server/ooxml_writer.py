@@ -0,0 +1,198 @@
+import re
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from docx.document import Document as DocumentClass
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from docx.oxml.shape import CT_Inline
+from docx.shared import Cm, Emu
+from lxml import etree
+
+from server.data_models import Chunk, group_by_level
+from server.html_parser import HTMLToWordParser, Picture, TextRun, picture_size
+from server.media_store import media_file
+
+# 直接拼接 word/document.xml 的表格行，绕过 python-docx 的对象模型；
+# 输出的结构、样式与 document_utils.generate_tables 保持一致。
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+COLUMN_WIDTHS = [1.0, 8.0, 8.0]
+
+TBL_PR = (
+    "<w:tblPr>"
+    '<w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLayout w:type="fixed"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" '
+    'w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+    "<w:tblBorders>"
+    '<w:insideH w:val="single" w:sz="4"/>'
+    '<w:top w:val="single" w:sz="4"/>'
+    '<w:bottom w:val="single" w:sz="4"/>'
+    "</w:tblBorders>"
+    "</w:tblPr>"
+)
+
+SPECIAL_CHARS = re.compile(r"([\t\r\n])")
+
+TBL_TAG = f"{{{W_NS}}}tbl"
+TR_TAG = f"{{{W_NS}}}tr"
+
+HEADING_FONT = '<w:rFonts w:ascii="Bookman Old Style" w:hAnsi="Bookman Old Style"/>'
+
+# 片段中的图片先以 "media:{文件名}" 占位引用，追加到目标文档时再换成该文档的关系 ID；
+# 片段可能在其他进程的文档副本中生成，原有的关系 ID 在目标文档中无效
+MEDIA_EMBED_PREFIX = "media:"
+
+
+def generate_tables_ooxml(doc: DocumentClass, records: list[Chunk]):
+    generate_level_tables_ooxml(doc, group_by_level(records))
+
+
+def generate_level_tables_ooxml(
+    doc: DocumentClass,
+    levels: dict[str, list[Chunk]],
+    first_numbers: dict[str, int] | None = None,
+):
+    first_numbers = first_numbers or {}
+    for level, chunks in sorted(levels.items(), key=lambda item: item[0]):
+        fragment = level_fragment_ooxml(doc, level, chunks, first_numbers.get(level, 1))
+        append_fragment(doc, fragment)
+
+
+def level_fragment_ooxml(
+    doc: DocumentClass, level: str, chunks: list[Chunk], first_number: int = 1
+) -> str:
+    # 单个级别的标题、表格与空段落，序列化为 <w:body> 片段
+    heading_style = doc.styles["Heading 2"].style_id
+    number_style = doc.styles["number"].style_id
+    section = doc.sections[-1]
+    block_width = section.page_width - section.left_margin - section.right_margin
+    grid = _grid_xml(Emu(block_width // len(COLUMN_WIDTHS)).twips)
+    tc_prs = [
+        f'<w:tcPr><w:tcW w:type="dxa" w:w="{Cm(width).twips}"/>'
+        '<w:vAlign w:val="center"/></w:tcPr>'
+        for width in COLUMN_WIDTHS
+    ]
+
+    parts = [
+        f'<w:body xmlns:w="{W_NS}">'
+        f'<w:p><w:pPr><w:pStyle w:val="{heading_style}"/></w:pPr>'
+        f"<w:r><w:rPr>{HEADING_FONT}</w:rPr>{_text_xml(level)}</w:r></w:p>"
+        f"<w:tbl>{TBL_PR}{grid}"
+    ]
+    for i, chunk in enumerate(chunks):
+        parts.append("<w:tr>")
+        parts.append(
+            f"<w:tc>{tc_prs[0]}<w:p><w:r><w:rPr>"
+            f'<w:rStyle w:val="{number_style}"/></w:rPr>'
+            f"<w:t>{i + first_number:02d}</w:t></w:r></w:p></w:tc>"
+        )
+        parts.append(_cell_xml(tc_prs[1], chunk.get_merged_front()))
+        parts.append(_cell_xml(tc_prs[2], chunk.get_merged_back()))
+        parts.append("</w:tr>")
+    parts.append("</w:tbl><w:p/></w:body>")
+    return "".join(parts)
+
+
+def append_fragment(doc: DocumentClass, fragment: str):
+    # 将 <w:body> 片段中的各块追加到正文末尾（sectPr 之前）
+    body = doc.element.body
+    root = parse_xml(fragment)
+    _link_pictures(doc, root)
+    for element in list(root):
+        rows = element.findall(TR_TAG) if element.tag == TBL_TAG else []
+        for row in rows:
+            element.remove(row)
+        _append_block(body, element)
+        # 逐行移入：lxml 跨文档移动整个大子树的开销随行数超线性增长，逐行移动则是线性的
+        for row in rows:
+            element.append(row)
+
+
+def _link_pictures(doc: DocumentClass, root):
+    # 同一图片在目标文档中只有一个图片部件和一个关系；绘图对象 ID 重新编号以免重复
+    if next(root.iter(qn("wp:docPr")), None) is None:
+        return
+    rIds: dict[str, str | None] = {}
+    for blip in list(root.iter(qn("a:blip"))):
+        embed = blip.get(qn("r:embed"), "")
+        if not embed.startswith(MEDIA_EMBED_PREFIX):
+            continue
+        name = embed[len(MEDIA_EMBED_PREFIX) :]
+        if name not in rIds:
+            path = media_file(name)
+            rIds[name] = doc.part.get_or_add_image(str(path))[0] if path else None
+        if rIds[name] is None:
+            # 片段生成后图片被清理：去掉整个图片 run
+            run = next(blip.iterancestors(qn("w:r")))
+            run.getparent().remove(run)
+        else:
+            blip.set(qn("r:embed"), rIds[name])
+    doc_prs = list(root.iter(qn("wp:docPr")))
+    next_id = doc.part.next_id
+    for i, doc_pr in enumerate(doc_prs):
+        doc_pr.set("id", str(next_id + i))
+
+
+def _append_block(body, element):
+    sect_pr = body.sectPr
+    if sect_pr is None:
+        body.append(element)
+    else:
+        sect_pr.addprevious(element)
+
+
+def _grid_xml(col_width: int) -> str:
+    cols = "".join(f'<w:gridCol w:w="{col_width}"/>' for _ in COLUMN_WIDTHS)
+    return f"<w:tblGrid>{cols}</w:tblGrid>"
+
+
+def _cell_xml(tc_pr: str, html: str) -> str:
+    paragraphs = HTMLToWordParser.compile(html)
+    if not paragraphs:
+        return f"<w:tc>{tc_pr}<w:p/></w:tc>"
+    body = "".join(
+        f"<w:p>{''.join(_item_xml(item) for item in runs)}</w:p>" if runs else "<w:p/>"
+        for runs in paragraphs
+    )
+    return f"<w:tc>{tc_pr}{body}</w:tc>"
+
+
+def _item_xml(item: TextRun | Picture) -> str:
+    if isinstance(item, Picture):
+        # 编译结果与图片 XML 都有缓存，文件是否仍存在每次都要检查
+        return _picture_xml(item.name) if media_file(item.name) else ""
+    return _run_xml(item)
+
+
+@lru_cache(maxsize=1024)
+def _picture_xml(name: str) -> str:
+    cx, cy = picture_size(name)
+    inline = CT_Inline.new_pic_inline(1, f"{MEDIA_EMBED_PREFIX}{name}", name, cx, cy)
+    return f"<w:r><w:drawing>{etree.tostring(inline, encoding='unicode')}</w:drawing></w:r>"
+
+
+def _run_xml(run: TextRun) -> str:
+    text, (bold, italic, underline, subscript) = run
+    r_pr = (
+        ("<w:b/>" if bold else '<w:b w:val="0"/>')
+        + ("<w:i/>" if italic else '<w:i w:val="0"/>')
+        + ('<w:u w:val="single"/>' if underline else '<w:u w:val="none"/>')
+        + ('<w:vertAlign w:val="subscript"/>' if subscript else "")
+    )
+    return f"<w:r><w:rPr>{r_pr}</w:rPr>{_text_xml(text)}</w:r>"
+
+
+def _text_xml(text: str) -> str:
+    # 与 python-docx 的 Run.text 相同：\t 转为 <w:tab/>，换行转为 <w:br/>
+    parts: list[str] = []
+    for piece in SPECIAL_CHARS.split(text):
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\r", "\n"):
+            parts.append("<w:br/>")
+        elif piece:
+            space = ' xml:space="preserve"' if piece.strip() != piece else ""
+            parts.append(f"<w:t{space}>{escape(piece)}</w:t>")
+    return "".join(parts)
@@ -0,0 +1,60 @@
+from typing import AsyncIterator
+
+from pydantic import ValidationError
+
+from server.admission import payload_cost
+from server.generation import ExportOptions, Filenames, StreamHeader
+from server.jobs import run_stream_generation
+
+# 每批发送给工作进程的条目数
+STREAM_BATCH_SIZE = 500
+# 未提供 Content-Length（分块上传）时按此大小估算生成开销
+STREAM_ASSUMED_BYTES = 4 * 1024**2
+
+
+async def iter_ndjson_lines(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # 只保留未结束的行尾，每个数据块只扫描一次
+    tail: list[bytes] = []
+    async for piece in body:
+        start = 0
+        while (end := piece.find(b"\n", start)) != -1:
+            line = b"".join((*tail, piece[start:end])) if tail else piece[start:end]
+            tail = []
+            start = end + 1
+            if line.strip():
+                yield line
+        if start < len(piece):
+            tail.append(piece[start:])
+    line = b"".join(tail)
+    if line.strip():
+        yield line
+
+
+async def _line_batches(lines: AsyncIterator[bytes]) -> AsyncIterator[list[bytes]]:
+    # 主进程只分帧，原始行按批转发；校验在工作进程中进行
+    batch: list[bytes] = []
+    async for line in lines:
+        batch.append(line)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def run_stream(
+    body: AsyncIterator[bytes], options: ExportOptions, size: int | None = None
+) -> Filenames:
+    # 首行为文档头，其后每行一个 Chunk
+    lines = iter_ndjson_lines(body)
+    header_line = await anext(lines, None)
+    if header_line is None:
+        raise ValueError("Empty upload: expected a header line")
+    try:
+        header = StreamHeader.model_validate_json(header_line)
+    except ValidationError as e:
+        raise ValueError(f"Line 1: {e}") from None
+    cost = payload_cost(size if size is not None else STREAM_ASSUMED_BYTES)
+    return await run_stream_generation(
+        header, _line_batches(lines), options=options, cost=cost
+    )
@@ -29,3 +29,7 @@ class ChunkInput(BaseModel):
         description="List of additional example sentences. Each item is an object with front/back/icon. "
         'Example: [{"front": "...", "back": "..."}]',
     )
+
+
+class ChunkUpdate(ChunkInput):
+    id: str = Field(description="Card id returned by add_cards")